@@ -0,0 +1,60 @@
+import gc
+import sys
+import time
+import skia
+import browser_ui
+from browser_ui import Browser
+from draw import Blend, DrawRRect, DrawText, get_font
+
+COMMANDS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+EFFECTS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+COLUMNS = 4
+
+def make_display_list(num_commands, num_effects):
+  font = get_font(12, "normal", "roman")
+  cards = num_commands // 2
+  display_list = [DrawRRect(skia.Rect.MakeXYWH(0, -30, 800, 24), 0, skia.ColorLTGRAY)]
+  for i in range(cards):
+    x = (i % COLUMNS) * 200
+    y = (i // COLUMNS) * 30
+    rect = skia.Rect.MakeXYWH(x, y, 190, 24)
+    cmds = [
+      DrawRRect(rect, 4, skia.ColorLTGRAY),
+      DrawText(x + 4, y + 4, "card {}".format(i), font, skia.ColorBLACK),
+    ]
+    if i < num_effects:
+      cmds = [Blend(0.5, None, None, cmds)]
+    display_list.extend(cmds)
+  return display_list
+
+def make_browser(display_list):
+  browser = object.__new__(Browser)
+  browser.skia_context = None
+  browser.active_tab_display_list = display_list
+  browser.composited_layers = []
+  browser.tab_damage = skia.Region()
+  return browser
+
+def run(use_index):
+  browser_ui.COMPOSITE_SPATIAL_INDEX = use_index
+  browser = make_browser(make_display_list(COMMANDS, EFFECTS))
+  gc.collect()
+  start = time.perf_counter()
+  browser.composite()
+  elapsed = time.perf_counter() - start
+  layers = [
+    [id(item) for item in layer.display_items]
+    for layer in browser.composited_layers
+  ]
+  return elapsed, layers
+
+if __name__ == "__main__":
+  print("{:>8} {:>10} {:>8} {:>8} {:>14}".format(
+    "layers", "commands", "effects", "count", "composite (s)"))
+  results = {}
+  for name, use_index in [("scan", False), ("index", True)]:
+    elapsed, layers = run(use_index)
+    results[name] = [len(layer) for layer in layers]
+    print("{:>8} {:>10} {:>8} {:>8} {:>14.3f}".format(
+      name, COMMANDS, EFFECTS, len(layers), elapsed))
+  assert results["scan"] == results["index"]
@@ -0,0 +1,71 @@
+import gc
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+import layout
+from css import DEFAULT_STYLE_SHEET, AncestorFilter, StyleStore, style, cascade_priority
+from dom import HTMLParser
+from layout import DocumentLayout
+from constants import WIDTH
+
+PARAGRAPHS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+REPEATS = 3
+
+def make_page(num_paragraphs):
+  return "".join(
+    "<p>Paragraph {} has a few <b>bold</b> and <i>italic</i> words in it, ".format(i) +
+    "followed by enough plain text to wrap onto a second line of the page.</p>"
+    for i in range(num_paragraphs)
+  )
+
+def load(use_graph):
+  layout.LAYOUT_FIELD_GRAPH = use_graph
+  nodes = HTMLParser(make_page(PARAGRAPHS)).parse()
+  frame = SimpleNamespace(
+    tab=SimpleNamespace(dark_mode=False),
+    set_needs_render=lambda: None,
+    invalidate_paint=lambda node: None,
+    style_store=StyleStore(),
+  )
+  style(nodes, sorted(DEFAULT_STYLE_SHEET, key=cascade_priority), frame, AncestorFilter())
+  return DocumentLayout(nodes, None)
+
+def timed(fn):
+  gc.collect()
+  start = time.perf_counter()
+  fn()
+  return time.perf_counter() - start
+
+def run(use_graph):
+  document = load(use_graph)
+  tracemalloc.start()
+  document.layout(WIDTH, 1)
+  memory, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  times = []
+  for i in range(REPEATS):
+    document = load(use_graph)
+    initial = timed(lambda: document.layout(WIDTH, 1))
+
+    def resize():
+      document.width.mark()
+      document.layout(WIDTH - 100, 1)
+    relayout = timed(resize)
+
+    def zoom():
+      document.zoom.mark()
+      document.layout(WIDTH - 100, 1.1)
+    rezoom = timed(zoom)
+    times.append((initial, relayout, rezoom))
+
+  return (memory,) + tuple(min(phase) for phase in zip(*times))
+
+if __name__ == "__main__":
+  print("{:>8} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+    "fields", "paragraphs", "memory (MB)", "layout (s)", "resize (s)", "zoom (s)"))
+  for name, use_graph in [("objects", False), ("graph", True)]:
+    memory, initial, relayout, rezoom = run(use_graph)
+    print("{:>8} {:>10} {:>12.1f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+      name, PARAGRAPHS, memory / 1e6, initial, relayout, rezoom))
@@ -0,0 +1,65 @@
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from css import DEFAULT_STYLE_SHEET, AncestorFilter, StyleStore, style, cascade_priority, dirty_style
+from dom import HTMLParser, tree_to_list
+
+NODES = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+def make_page(num_nodes):
+  # Each item is an <li> with a text child and a <b> with a text child.
+  items = num_nodes // 4
+  return "<ul>" + "".join(
+    "<li>item {} <b>bold</b></li>".format(i) for i in range(items)
+  ) + "</ul>"
+
+def make_frame(compact):
+  return SimpleNamespace(
+    tab=SimpleNamespace(dark_mode=False),
+    set_needs_render=lambda: None,
+    invalidate_paint=lambda node: None,
+    style_store=StyleStore() if compact else None,
+  )
+
+def measure_memory(compact, rules):
+  nodes = HTMLParser(make_page(NODES)).parse()
+  frame = make_frame(compact)
+  tracemalloc.start()
+  style(nodes, rules, frame, AncestorFilter())
+  memory, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return memory
+
+def run(compact):
+  rules = sorted(DEFAULT_STYLE_SHEET, key=cascade_priority)
+  memory = measure_memory(compact, rules)
+
+  nodes = HTMLParser(make_page(NODES)).parse()
+  frame = make_frame(compact)
+  all_nodes = tree_to_list(nodes, [])
+
+  start = time.perf_counter()
+  style(nodes, rules, frame, AncestorFilter())
+  initial = time.perf_counter() - start
+
+  for node in all_nodes:
+    dirty_style(node)
+  start = time.perf_counter()
+  style(nodes, rules, frame, AncestorFilter())
+  full = time.perf_counter() - start
+
+  dirty_style(all_nodes[len(all_nodes) // 2])
+  start = time.perf_counter()
+  style(nodes, rules, frame, AncestorFilter())
+  single = time.perf_counter() - start
+
+  return len(all_nodes), memory, initial, full, single
+
+if __name__ == "__main__":
+  print("{:>10} {:>8} {:>12} {:>10} {:>10} {:>10}".format(
+    "storage", "nodes", "memory (MB)", "style (s)", "full (s)", "one (ms)"))
+  for name, compact in [("fields", False), ("compact", True)]:
+    count, memory, initial, full, single = run(compact)
+    print("{:>10} {:>8} {:>12.1f} {:>10.3f} {:>10.3f} {:>10.2f}".format(
+      name, count, memory / 1e6, initial, full, single * 1000))
@@ -4,11 +4,11 @@ import urllib.parse
 import math
 import threading
 import OpenGL.GL
-from constants import HEIGHT, WIDTH, VSTEP, SCROLL_STEP, REFRESH_RATE_SEC, INHERITED_PROPERTIES, BROKEN_IMAGE
+from constants import HEIGHT, WIDTH, VSTEP, SCROLL_STEP, REFRESH_RATE_SEC, INHERITED_PROPERTIES, BROKEN_IMAGE, COMPACT_STYLE_STORAGE, LAZY_LAYOUT, COMPOSITE_SPATIAL_INDEX, PARTIAL_REDRAW
 from dom import HTMLParser, Text, Element, tree_to_list
-from css import DEFAULT_STYLE_SHEET, CSSParser, style, cascade_priority, absolute_bounds_for_obj, dirty_style
-from layout import DocumentLayout, add_parent_pointers, dpx, paint_tree, BlockLayout, ProtectedField
-from draw import DrawLine, DrawOutline, DrawText, linespace, PaintCommand, CompositedLayer, DrawCompositedLayer, Blend, local_to_absolute, get_font
+from css import DEFAULT_STYLE_SHEET, CSSParser, AncestorFilter, StyleStore, style, cascade_priority, absolute_bounds_for_obj, dirty_style, dirty_style_descendants
+from layout import DocumentLayout, SpatialIndex, add_parent_pointers, dpx, paint_tree, invalidate_paint, subtree_objects, tree_position, BlockLayout, LineLayout
+from draw import DrawLine, DrawOutline, DrawText, PaintCommand, CompositedLayer, DrawCompositedLayer, TILE_CACHE, Blend, local_to_absolute, get_font, measure_text, text_width
 from network import URL
 from js import JSContext
 from task import TaskRunner, Task, MeasureTime, CommitData
@@ -79,6 +79,12 @@ class Browser:
     self.draw_list = []
     self.dark_mode = False
 
+    self.frame_surface = None
+    self.drawn_state = None
+    self.drawn_scroll = 0
+    self.damage = skia.Region()
+    self.tab_damage = skia.Region()
+
     self.accessibility_is_on = False
     self.has_spoken_document = False
     self.needs_speak_hovered_node = False
@@ -96,6 +102,8 @@ class Browser:
     if tab == self.active_tab:
       self.active_tab_url = data.url
       if data.scroll is not None:
+        if data.scroll != self.active_tab_scroll:
+          self.set_needs_raster()
         self.active_tab_scroll = data.scroll
       self.root_frame_focused = data.root_frame_focused
       self.active_tab_height = data.height
@@ -155,6 +163,7 @@ class Browser:
           self.skia_context, skia.Budgeted.kNo,
           skia.ImageInfo.MakeN32Premul(width, math.ceil(self.chrome.bottom))
       )
+      self.frame_surface = None
 
       if self.active_tab:
         self.active_tab.tab_height = height - self.chrome.bottom
@@ -193,7 +202,7 @@ class Browser:
       self.active_tab_scroll = self.clamp_scroll(
         self.active_tab_scroll + SCROLL_STEP
       )
-      self.set_needs_draw()
+      self.set_needs_raster()
       self.needs_animation_frame = True
       self.lock.release()
       return
@@ -210,7 +219,7 @@ class Browser:
     self.active_tab_scroll = self.clamp_scroll(
       self.active_tab_scroll - SCROLL_STEP
     )
-    self.set_needs_draw()
+    self.set_needs_raster()
     self.needs_animation_frame = True
     self.lock.release()
 
@@ -273,10 +282,22 @@ class Browser:
     self.needs_draw = True
 
   def raster_tab(self):
+    viewport = skia.Rect.MakeXYWH(
+      0, self.active_tab_scroll,
+      self.width, self.height - self.chrome.bottom)
+    scheduled = {}
+    TILE_CACHE.begin_frame()
     for composited_layer in self.composited_layers:
-      composited_layer.raster()
+      scheduled[composited_layer] = composited_layer.raster(viewport)
+    rastered = len([tiles for tiles in scheduled.values() if tiles])
+    self.measure.counter('raster-layers', {
+      "rastered": rastered,
+      "reused": len(self.composited_layers) - rastered,
+      "tiles": sum(scheduled.values()),
+    })
 
   def raster_chrome(self):
+    add_damage(self.damage, skia.Rect.MakeWH(self.width, self.chrome.bottom))
     canvas = self.chrome_surface.getCanvas()
     if self.dark_mode:
       background_color = skia.ColorBLACK
@@ -287,27 +308,84 @@ class Browser:
     for cmd in self.chrome.paint():
       cmd.execute(canvas)
 
-  def draw(self):
-    canvas = self.root_surface.getCanvas()
-
-    if self.dark_mode:
-      canvas.clear(skia.ColorBLACK)
-    else:
-      canvas.clear(skia.ColorWHITE)
-
-    canvas.save()
-    canvas.translate(0, self.chrome.bottom - self.active_tab_scroll)
-    for item in self.draw_list:
-      item.execute(canvas)
-    canvas.restore()
+  def damage_all(self):
+    self.damage.setRect(skia.IRect.MakeWH(self.width, self.height))
 
-    chrome_rect = skia.Rect.MakeLTRB(
-        0, 0, self.width, self.chrome.bottom)
-    canvas.save()
-    canvas.clipRect(chrome_rect)
-    self.chrome_surface.draw(canvas, 0, 0)
-    canvas.restore()
+  def draw(self):
+    if not self.frame_surface:
+      self.frame_surface = skia.Surface.MakeRenderTarget(
+        self.skia_context, skia.Budgeted.kNo,
+        skia.ImageInfo.MakeN32Premul(self.width, self.height))
+      if not self.frame_surface:
+        self.frame_surface = skia.Surface(self.width, self.height)
+      self.drawn_state = None
+    canvas = self.frame_surface.getCanvas()
+
+    state = (self.width, self.height, self.chrome.bottom, self.dark_mode)
+    tab_rect = skia.Rect.MakeLTRB(0, self.chrome.bottom, self.width, self.height)
+    scroll_delta = self.active_tab_scroll - self.drawn_scroll
+    if not PARTIAL_REDRAW or state != self.drawn_state or self.accessibility_is_on:
+      self.damage_all()
+    elif scroll_delta:
+      if scroll_delta == int(scroll_delta) and abs(scroll_delta) < tab_rect.height():
+        snapshot = self.frame_surface.makeImageSnapshot()
+        canvas.save()
+        canvas.clipRect(tab_rect)
+        canvas.drawImage(snapshot, 0, -scroll_delta)
+        canvas.restore()
+        if scroll_delta > 0:
+          add_damage(self.damage, skia.Rect.MakeLTRB(
+            0, self.height - scroll_delta, self.width, self.height))
+        else:
+          add_damage(self.damage, skia.Rect.MakeLTRB(
+            0, self.chrome.bottom, self.width, self.chrome.bottom - scroll_delta))
+      else:
+        add_damage(self.damage, tab_rect)
+    for rect in self.tab_damage:
+      add_damage(self.damage, skia.Rect.Make(rect).makeOffset(
+        0, self.chrome.bottom - self.active_tab_scroll))
+    damage = self.damage
+    damage.op(skia.IRect.MakeWH(self.width, self.height), skia.Region.kIntersect_Op)
+
+    if not damage.isEmpty():
+      canvas.save()
+      canvas.clipRegion(damage)
+      if self.dark_mode:
+        canvas.clear(skia.ColorBLACK)
+      else:
+        canvas.clear(skia.ColorWHITE)
+
+      canvas.save()
+      canvas.translate(0, self.chrome.bottom - self.active_tab_scroll)
+      for item in self.draw_list:
+        item.execute(canvas)
+      canvas.restore()
+
+      chrome_rect = skia.Rect.MakeLTRB(
+          0, 0, self.width, self.chrome.bottom)
+      canvas.clipRect(chrome_rect)
+      self.chrome_surface.draw(canvas, 0, 0)
+      canvas.restore()
+
+    missing = skia.Region()
+    for rect in TILE_CACHE.missing:
+      add_damage(missing, rect.makeOffset(
+        0, self.active_tab_scroll - self.chrome.bottom))
+    TILE_CACHE.missing = []
+
+    self.measure.counter('draw-damage', {
+      "rects": damage.computeRegionComplexity(),
+      "damaged": sum(rect.width() * rect.height() for rect in damage),
+      "window": self.width * self.height,
+    })
+    self.damage = skia.Region()
+    self.tab_damage = missing
+    if not missing.isEmpty():
+      self.set_needs_raster()
+    self.drawn_state = state
+    self.drawn_scroll = self.active_tab_scroll
 
+    self.frame_surface.draw(self.root_surface.getCanvas(), 0, 0)
     self.root_surface.flushAndSubmit()
     sdl2.SDL_GL_SwapWindow(self.sdl_window)
 
@@ -319,15 +397,18 @@ class Browser:
     
     self.measure.time('composite-raster-and-draw')
     if self.needs_composite:
+      self.needs_composite = False
       self.measure.time('composite')
       self.composite()
       self.measure.stop('composite')
     if self.needs_raster:
+      self.needs_raster = False
       self.measure.time('raster')
       self.raster_chrome()
       self.raster_tab()
       self.measure.stop('raster')
     if self.needs_draw:
+      self.needs_draw = False
       self.measure.time('draw')
       self.paint_draw_list()
       self.draw()
@@ -336,10 +417,6 @@ class Browser:
 
     if self.needs_accessibility:
       self.update_accessibility()
-    
-    self.needs_composite = False
-    self.needs_raster = False
-    self.needs_draw = False
     self.needs_accessibility = False
 
     self.lock.release()
@@ -415,6 +492,10 @@ class Browser:
     self.active_tab.task_runner.schedule_task(task)
 
   def composite(self):
+    old_layers = dict(
+      (tuple(layer.display_items), layer)
+      for layer in self.composited_layers
+    )
     self.composited_layers = []
     add_parent_pointers(self.active_tab_display_list)
     all_commands = []
@@ -427,7 +508,54 @@ class Browser:
       if not cmd.parent or cmd.parent.needs_compositing
     ]
 
-    for cmd in non_composited_commands:
+    if COMPOSITE_SPATIAL_INDEX:
+      self.assign_layers(non_composited_commands)
+    else:
+      self.assign_layers_by_scan(non_composited_commands)
+
+    old_order = dict(
+      (layer, i) for i, layer in enumerate(old_layers.values())
+    )
+    reused = []
+    for layer in self.composited_layers:
+      layer.effects = layer.effect_chain()
+      layer.drawn_rect = layer.drawn_bounds()
+      old_layer = old_layers.pop(tuple(layer.display_items), None)
+      if old_layer and layer.reuse(old_layer):
+        reused.append(old_layer)
+        if layer.effects == old_layer.effects: continue
+      add_damage(self.tab_damage, layer.drawn_rect)
+      if old_layer:
+        add_damage(self.tab_damage, old_layer.drawn_rect)
+    for old_layer in old_layers.values():
+      add_damage(self.tab_damage, old_layer.drawn_rect)
+    if reused != sorted(reused, key=old_order.get):
+      self.damage_all()
+
+    self.active_tab_height = 0
+    for layer in self.composited_layers:
+      self.active_tab_height = max(self.active_tab_height, layer.absolute_bounds().bottom())
+
+  def assign_layers(self, commands):
+    index = SpatialIndex()
+    order = {}
+    last_layer_for_parent = {}
+    for cmd in commands:
+      rect = local_to_absolute(cmd, cmd.rect)
+      merge_layer = last_layer_for_parent.get(cmd.parent)
+      overlap_layer = index.query(rect)
+      if merge_layer and (not overlap_layer or order[merge_layer] >= order[overlap_layer]):
+        merge_layer.add(cmd)
+        index.grow(merge_layer, rect)
+      else:
+        layer = CompositedLayer(self.skia_context, cmd)
+        order[layer] = len(self.composited_layers)
+        self.composited_layers.append(layer)
+        last_layer_for_parent[cmd.parent] = layer
+        index.insert(layer.absolute_bounds().makeOffset(0, 0), layer)
+
+  def assign_layers_by_scan(self, commands):
+    for cmd in commands:
       did_break = False
       for layer in reversed(self.composited_layers):
         if layer.can_merge(cmd):
@@ -446,10 +574,6 @@ class Browser:
         layer = CompositedLayer(self.skia_context, cmd)
         self.composited_layers.append(layer)
 
-    self.active_tab_height = 0
-    for layer in self.composited_layers:
-      self.active_tab_height = max(self.active_tab_height, layer.absolute_bounds().bottom())
-
   def paint_draw_list(self):
     new_effects = {}
     self.draw_list = []
@@ -459,6 +583,8 @@ class Browser:
       parent = composited_layer.display_items[0].parent
       while parent:
         new_parent = self.get_latest(parent)
+        if new_parent is not parent:
+          add_damage(self.tab_damage, local_to_absolute(parent, parent.rect))
         if new_parent in new_effects:
           new_effects[new_parent].children.append(current_effect)
           break
@@ -483,7 +609,7 @@ class Browser:
     
     if self.hovered_a11y_node:
       for bound in self.hovered_a11y_node.bounds:
-        self.draw_list.append(DrawOutline(bound, "white" if self.dark_mode else "black", 2))
+        self.draw_list.append(DrawOutline(bound, skia.ColorWHITE if self.dark_mode else skia.ColorBLACK, 2))
 
   def get_latest(self, effect):
     node = effect.node
@@ -590,8 +716,11 @@ class Frame:
     self.loaded = False
 
     self.document = None
+    self.style_store = None
+    self.hit_index = None
     self.scroll = 0
     self.scroll_changed_in_frame = False
+    self.layout_changed_in_frame = False
     self.needs_focus_scroll = False
     self.nodes = None
     self.url = None
@@ -632,6 +761,7 @@ class Frame:
         self.allowed_origins = csp[1:]
 
     self.nodes = HTMLParser(body).parse()
+    self.style_store = StyleStore() if COMPACT_STYLE_STORAGE else None
     
     if self.js: self.js.discarded = True
     self.js = self.tab.get_js(url)
@@ -714,36 +844,84 @@ class Frame:
       self.tab.task_runner.schedule_task(task)
 
     self.document = DocumentLayout(self.nodes, self)
+    self.hit_index = None
     self.set_needs_render()
     self.loaded = True
   
   def render(self):
     if self.parent_frame is None:
-      self.frame_width = self.tab.browser.width
-      self.frame_height = self.tab.tab_height
-      if hasattr(self, "document") and self.document:
+      frame_width = self.tab.browser.width
+      if self.document and frame_width != self.frame_width:
         self.document.width.mark()
-        self.needs_layout = True
+      self.frame_width = frame_width
+      self.frame_height = self.tab.tab_height
 
     if self.needs_style:
       if self.tab.dark_mode:
         INHERITED_PROPERTIES["color"] = "white"
       else:
         INHERITED_PROPERTIES["color"] = "black"
-      style(self.nodes, sorted(self.rules, key=cascade_priority), self)
+      ancestors = AncestorFilter()
+      style(self.nodes, sorted(self.rules, key=cascade_priority), self, ancestors)
+      self.tab.browser.measure.counter('style-ancestor-filter', {
+        "checked": ancestors.checked,
+        "rejected": ancestors.rejected,
+      })
       self.needs_layout = True
       self.needs_style = False
 
-    if self.needs_layout:
+    if LAZY_LAYOUT:
+      self.document.set_viewport(self.scroll, self.frame_height)
+
+    if self.needs_layout or self.document.layout_needed():
+      self.tab.browser.measure.time('layout')
       self.document.layout(self.frame_width, self.tab.zoom)
+      self.tab.browser.measure.stop('layout')
+      text_widths = text_width.cache_info()
+      self.tab.browser.measure.counter('text-width-cache', {
+        "hits": text_widths.hits,
+        "misses": text_widths.misses,
+      })
       self.tab.needs_accessibility = True
       self.needs_paint = True
       self.needs_layout = False
+      self.layout_changed_in_frame = True
+
+    if self.needs_focus_scroll:
+      if self.tab.focus and self.tab.focused_frame == self:
+        self.scroll_to(self.tab.focus)
+        if LAZY_LAYOUT:
+          self.document.set_viewport(self.scroll, self.frame_height)
+      self.needs_focus_scroll = False
+
+    if self.document.estimated_blocks:
+      self.layout_visible_blocks()
 
     clamped_scroll = self.clamp_scroll(self.scroll)
     if clamped_scroll != self.scroll:
       self.scroll_changed_in_frame = True
     self.scroll = clamped_scroll
+    self.update_hit_index()
+
+  def layout_visible_blocks(self):
+    realized = self.document.realize_visible()
+    if not realized: return
+    while realized:
+      self.tab.browser.measure.time('layout')
+      self.document.layout(self.frame_width, self.tab.zoom)
+      self.tab.browser.measure.stop('layout')
+      for block, y, height in realized:
+        if y < self.scroll:
+          self.scroll += block.height.get() - height
+          self.scroll_changed_in_frame = True
+      self.document.set_viewport(self.scroll, self.frame_height)
+      realized = self.document.realize_visible()
+    self.layout_changed_in_frame = True
+    self.tab.needs_accessibility = True
+    self.tab.set_needs_paint()
+    self.tab.browser.measure.counter('lazy-layout', {
+      "estimated": len(self.document.estimated_blocks),
+    })
 
   def advance_tab(self):
     focusable_nodes = [node
@@ -770,6 +948,7 @@ class Frame:
       self.needs_focus_scroll = True
     if self.tab.focus:
       self.tab.focus.is_focused = False
+      self.tab.focused_frame.invalidate_paint(self.tab.focus)
       dirty_style(self.tab.focus)
     if self.tab.focused_frame and self.tab.focused_frame != self:
       self.tab.focused_frame.set_needs_render()
@@ -777,12 +956,14 @@ class Frame:
     self.tab.focused_frame = self
     if node:
       node.is_focused = True
+      self.invalidate_paint(node)
       dirty_style(node)
     self.set_needs_render()
 
   def activate_element(self, elt):
     if elt.tag == "input":
       elt.attributes["value"] = ""
+      self.invalidate_paint(elt)
       self.set_needs_render()
     elif elt.tag == "a" and "href" in elt.attributes:
       url = self.url.resolve(elt.attributes["href"])
@@ -818,6 +999,7 @@ class Frame:
         self.activate_element(self.tab.focus)
       if self.js.dispatch_event("keydown", self.tab.focus, self.window_id): return
       self.tab.focus.attributes["value"] += char
+      self.invalidate_paint(self.tab.focus)
       self.set_needs_render()
     elif self.tab.focus and "contenteditable" in self.tab.focus.attributes:
       text_nodes = [
@@ -829,6 +1011,7 @@ class Frame:
       else:
         last_text = Text("", self.tab.focus)
         self.tab.focus.children.append(last_text)
+        dirty_style_descendants(self.tab.focus)
       last_text.text += char
       obj = self.tab.focus.layout_object
       while not isinstance(obj, BlockLayout):
@@ -838,10 +1021,12 @@ class Frame:
  
   def scroll_to(self, elt):
     assert not (self.needs_style or self.needs_layout)
-    objs = [
-      obj for obj in tree_to_list(self.document, [])
-      if obj.node == self.tab.focus
-    ]
+    while self.document.realize_node(elt):
+      self.document.layout(self.frame_width, self.tab.zoom)
+      self.layout_changed_in_frame = True
+      self.tab.needs_accessibility = True
+      self.tab.set_needs_paint()
+    objs = self.document.fragments_for(self.tab.focus)
     if not objs: return
     obj = objs[0]
 
@@ -852,20 +1037,56 @@ class Frame:
     self.scroll_changed_in_frame = True
     self.tab.set_needs_paint()
 
+  def invalidate_paint(self, node):
+    if self.document:
+      self.document.invalidate_paint(node)
+
+  def invalidate_hit_test(self, node):
+    if not self.hit_index: return
+    objects = []
+    for descendant in tree_to_list(node, []):
+      objects.extend(self.document.fragments_for(descendant))
+    for obj in subtree_objects(objects):
+      self.document.relaid_out[obj] = True
+
+  def update_hit_index(self):
+    relaid_out = self.document.relaid_out
+    self.document.relaid_out = {}
+    if not self.hit_index: return
+    translations = {}
+    for obj, laid_out in relaid_out.items():
+      if laid_out:
+        self.hit_index.update(obj, absolute_bounds_for_obj(obj, translations))
+      elif obj in self.hit_index.entries:
+        self.hit_index.remove(obj)
+
+  def hit_test_index(self):
+    if not self.hit_index:
+      self.hit_index = SpatialIndex()
+      self.document.relaid_out = {}
+      translations = {}
+      for obj in tree_to_list(self.document, []):
+        self.hit_index.insert(absolute_bounds_for_obj(obj, translations), obj)
+    return self.hit_index
+
+  def hit_test(self, x, y):
+    hits = self.hit_test_index().hits(x, y)
+    if not hits: return None
+    return max([entry[2] for entry in hits], key=tree_position)
+
   def click(self, x, y):
-    self.focus_element(None)
     y += self.scroll
-    loc_rect = skia.Rect.MakeXYWH(x, y, 1, 1)
-    objs = [obj for obj in tree_to_list(self.document, [])
-            if absolute_bounds_for_obj(obj).intersects(loc_rect)]
-    if not objs: return
-    elt = objs[-1].node
+    index = self.hit_test_index()
+    obj = self.hit_test(x, y)
+    self.focus_element(None)
+    if not obj: return
+    elt = obj.node
     if elt and self.js.dispatch_event("click", elt, self.window_id): return
     while elt:
       if isinstance(elt, Text):
         pass
       elif elt.tag == "iframe":
-        abs_bounds = absolute_bounds_for_obj(elt.layout_object)
+        abs_bounds = index.bounds[elt.layout_object]
         border = dpx(1, elt.layout_object.zoom.get())
         new_x = x - abs_bounds.left() - border
         new_y = y - abs_bounds.top() - border
@@ -954,6 +1175,9 @@ class Tab:
       self.needs_paint = True
 
     if self.needs_paint:
+      for id, frame in self.window_id_to_frame.items():
+        if frame.loaded and frame != self.root_frame and frame.document.painted_scroll != frame.scroll:
+          invalidate_paint(frame.document)
       self.display_list = []
       self.browser.measure.time('paint')
       paint_tree(self.root_frame.document, self.display_list)
@@ -980,6 +1204,7 @@ class Tab:
           value = animation.animate()
           if value:
             node.style[property_name].set(value)
+            frame.invalidate_paint(node)
             self.composited_updates.append(node)
             self.set_needs_paint()
 
@@ -987,11 +1212,10 @@ class Tab:
 
     self.render()
 
-    if self.focus and self.focused_frame.needs_focus_scroll:
-      self.focused_frame.scroll_to(self.focus)
-      self.focused_frame.needs_focus_scroll = False
-
     for (window_id, frame) in self.window_id_to_frame.items():
+      if frame.layout_changed_in_frame:
+        needs_composite = True
+        frame.layout_changed_in_frame = False
       if frame == self.root_frame: continue
       if frame.scroll_changed_in_frame:
         needs_composite = True
@@ -1093,7 +1317,7 @@ class Chrome:
     self.address_bar = ""
 
     self.font = get_font(12, "normal", "roman")
-    self.font_height = linespace(self.font)
+    self.font_height = self.font.linespace
     self.padding = 5
 
     self.layout(WIDTH)
@@ -1102,7 +1326,7 @@ class Chrome:
     self.tabbar_top = 0
     self.tabbar_bottom = self.font_height + 2*self.padding
 
-    plus_width = self.font.measureText("+") + 2*self.padding
+    plus_width = measure_text(self.font, "+") + 2*self.padding
     self.newtab_rect = skia.Rect.MakeLTRB(
       self.padding, self.padding,
       self.padding + plus_width,
@@ -1112,7 +1336,7 @@ class Chrome:
     self.urlbar_top = self.tabbar_bottom
     self.urlbar_bottom = self.urlbar_top + self.font_height + 2*self.padding
 
-    back_width = self.font.measureText("<") + 2*self.padding
+    back_width = measure_text(self.font, "<") + 2*self.padding
     self.back_rect = skia.Rect.MakeLTRB(
       self.padding,
       self.urlbar_top + self.padding,
@@ -1130,7 +1354,7 @@ class Chrome:
 
   def tab_rect(self, i):
     tabs_start = self.newtab_rect.right() + self.padding
-    tab_width = self.font.measureText("Tab X") + 2*self.padding
+    tab_width = measure_text(self.font, "Tab X") + 2*self.padding
     return skia.Rect.MakeLTRB(
       tabs_start + tab_width * i, self.tabbar_top,
       tabs_start + tab_width * (i + 1), self.tabbar_bottom
@@ -1138,9 +1362,9 @@ class Chrome:
   
   def paint(self):
     if self.browser.dark_mode:
-      color = "white"
+      color = skia.ColorWHITE
     else:
-      color = "black"
+      color = skia.ColorBLACK
     cmds = []
     cmds.append(DrawLine(0, self.bottom, self.browser.width, self.bottom, color, 1))
 
@@ -1182,13 +1406,13 @@ class Chrome:
         self.address_rect.top(),
         self.address_bar, self.font, color
       ))
-      w = self.font.measureText(self.address_bar)
+      w = measure_text(self.font, self.address_bar)
       cmds.append(DrawLine(
         self.address_rect.left() + self.padding + w,
         self.address_rect.top(),
         self.address_rect.left() + self.padding + w,
         self.address_rect.bottom(),
-        "red", 1
+        skia.ColorRED, 1
       ))
     else:
       url = str(self.browser.active_tab_url) if self.browser.active_tab_url else ""
@@ -1244,6 +1468,7 @@ class AccessibilityNode:
     self.children = []
     self.text = ""
     self.bounds = self.compute_bounds()
+    self.hit_index = None
 
     if isinstance(node, Text):
       if is_focusable(node.parent):
@@ -1343,20 +1568,18 @@ class AccessibilityNode:
     if isinstance(self.node, Text):
       return []
     inline = self.node.parent
-    bounds = []
     while not inline.layout_object: inline = inline.parent
+    document = inline.layout_object.document
 
-    children = inline.layout_object.children.get() if isinstance(inline.layout_object.children, ProtectedField) else inline.layout_object.children
-
-    for line in children:
-      line_bounds = skia.Rect.MakeEmpty()
-      for child in line.children:
-        if child.node.parent == self.node:
-          line_bounds.join(skia.Rect.MakeXYWH(
+    line_bounds = {}
+    for child_node in self.node.children:
+      for child in document.fragments_for(child_node):
+        if not isinstance(child.parent, LineLayout): continue
+        line_bounds.setdefault(child.parent, skia.Rect.MakeEmpty()).join(
+          skia.Rect.MakeXYWH(
             child.x.get(), child.y.get(), child.width.get(), child.height.get()
           ))
-      bounds.append(line_bounds)
-    return bounds
+    return sorted(line_bounds.values(), key=lambda bound: bound.top())
   
   def contains_point(self, x, y):
     for bound in self.bounds:
@@ -1365,12 +1588,14 @@ class AccessibilityNode:
     return False
   
   def hit_test(self, x, y):
-    node = None
-    if self.contains_point(x, y):
-      node = self
-    for child in self.children:
-      res = child.hit_test(x, y)
-      if res: node = res
+    if not self.hit_index:
+      self.hit_index = SpatialIndex()
+      for node in hit_test_targets(self, []):
+        for bound in node.bounds:
+          self.hit_index.insert(bound, node)
+    node = self.hit_index.hit_test(x, y, contains=True)
+    if isinstance(node, FrameAccessibilityNode):
+      return node.hit_test(x, y)
     return node
   
   def __repr__(self):
@@ -1382,7 +1607,7 @@ class FrameAccessibilityNode(AccessibilityNode):
   def __init__(self, node, parent=None):
     super().__init__(node, parent)
     self.scroll = self.node.frame.scroll
-    self.zoom = self.node.layout_object.zoom
+    self.zoom = self.node.layout_object.zoom.get()
 
   def build(self):
     self.build_internal(self.node.frame.nodes)
@@ -1403,6 +1628,16 @@ class FrameAccessibilityNode(AccessibilityNode):
     rect.offset(bounds.left(), bounds.top() - self.scroll)
     rect.intersect(bounds)
 
+def hit_test_targets(node, targets):
+  targets.append(node)
+  if node is targets[0] or not isinstance(node, FrameAccessibilityNode):
+    for child in node.children:
+      hit_test_targets(child, targets)
+  return targets
+
+def add_damage(region, rect):
+  region.op(rect.roundOut(), skia.Region.kUnion_Op)
+
 def is_focusable(node):
   if get_tabindex(node) <= 0:
     return False
@@ -7,6 +7,23 @@ HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 INPUT_WIDTH_PX = 200
 REFRESH_RATE_SEC = 0.033
+INLINE_STYLE_CACHE_SIZE = 1024
+TEXT_WIDTH_CACHE_SIZE = 65536
+COLOR_CACHE_SIZE = 1024
+FONT_CACHE_SIZE = 256
+COMPACT_STYLE_STORAGE = True
+LAYOUT_FIELD_GRAPH = True
+TEXT_RUN_LAYOUT = True
+LAZY_LAYOUT = True
+HIT_TEST_CELL_SIZE = 256
+PAINT_CACHE = True
+RECORD_LAYER_PICTURES = True
+TEXT_BLOB_BATCHING = True
+COMPOSITE_SPATIAL_INDEX = True
+TILE_SIZE = 512
+TILE_PREFETCH_MARGIN = 512
+TILE_CACHE_BYTES = 64 * 1024 * 1024
+PARTIAL_REDRAW = True
 SHOW_COMPOSITED_LAYER_BORDERS = False
 BROKEN_IMAGE = skia.Image.open("Broken_Image.png")
 IFRAME_WIDTH_PX = 300
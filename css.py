@@ -1,7 +1,8 @@
 import skia
+import functools
 from dom import Element
-from constants import INHERITED_PROPERTIES, REFRESH_RATE_SEC, CSS_PROPERTIES
-from draw import NumericAnimation
+from constants import INHERITED_PROPERTIES, REFRESH_RATE_SEC, CSS_PROPERTIES, INLINE_STYLE_CACHE_SIZE
+from draw import NumericAnimation, parse_color
 
 class CSSParser:
   def __init__(self, s):
@@ -140,21 +141,30 @@ class TagSelector:
     self.tag = tag
     self.priority = 1
 
-  def matches(self, node):
+  def matches(self, node, ancestors=None):
     return isinstance(node, Element) and self.tag == node.tag
+
+  def keys(self):
+    return [self.tag]
   
 class DescendantSelector:
   def __init__(self, ancestor, descendant):
     self.ancestor = ancestor
     self.descendant = descendant
     self.priority = ancestor.priority + descendant.priority
+    self.ancestor_hashes = AncestorFilter.hashes(ancestor.keys())
 
-  def matches(self, node):
+  def matches(self, node, ancestors=None):
     if not self.descendant.matches(node): return False
+    if ancestors and not ancestors.might_contain(self.ancestor_hashes):
+      return False
     while node.parent:
       if self.ancestor.matches(node.parent): return True
       node = node.parent
     return False
+
+  def keys(self):
+    return self.ancestor.keys() + self.descendant.keys()
   
 class PseudoclassSelector:
   def __init__(self, pseudoclass, base):
@@ -162,60 +172,89 @@ class PseudoclassSelector:
     self.base = base
     self.priority = self.base.priority
 
-  def matches(self, node):
+  def matches(self, node, ancestors=None):
     if not self.base.matches(node):
       return False
     if self.pseudoclass == "focus":
       return node.is_focused
     else:
       return False
+
+  def keys(self):
+    return self.base.keys()
   
   def __repr__(self):
     return "PseudoclassSelector({}, {})".format(self.pseudoclass, self.base)
   
+class AncestorFilter:
+  KEY_BITS = 12
+  KEY_MASK = (1 << KEY_BITS) - 1
+
+  def __init__(self):
+    self.counts = [0] * (1 << self.KEY_BITS)
+    self.checked = 0
+    self.rejected = 0
+
+  @classmethod
+  def hashes(cls, keys):
+    result = []
+    for key in keys:
+      h = hash(key)
+      result.append(h & cls.KEY_MASK)
+      result.append((h >> cls.KEY_BITS) & cls.KEY_MASK)
+    return result
+
+  def node_hashes(self, node):
+    if not isinstance(node, Element): return []
+    keys = [node.tag]
+    if "id" in node.attributes:
+      keys.append("#" + node.attributes["id"])
+    for name in node.attributes.get("class", "").split():
+      keys.append("." + name)
+    return self.hashes(keys)
+
+  def push(self, node):
+    for h in self.node_hashes(node):
+      self.counts[h] += 1
+
+  def pop(self, node):
+    for h in self.node_hashes(node):
+      self.counts[h] -= 1
+
+  def might_contain(self, hashes):
+    self.checked += 1
+    for h in hashes:
+      if not self.counts[h]:
+        self.rejected += 1
+        return False
+    return True
+
+  def __repr__(self):
+    return "AncestorFilter(checked={}, rejected={})".format(
+      self.checked, self.rejected)
+
 def cascade_priority(rule):
   media, selector, body = rule
   return selector.priority
 
-def style(node, rules, frame):
+def style(node, rules, frame, ancestors, shared_styles=None):
   if not node.style:
-    init_style(node)
-  needs_style = any([field.dirty for field in node.style.values()])
+    init_style(node, frame.style_store)
+  needs_style = node.style.is_dirty()
   if needs_style:
-    old_style = dict([
-      (property, field.value)
-      for property, field in node.style.items()
-    ])
-    new_style = CSS_PROPERTIES.copy()
-    for property, default_value in INHERITED_PROPERTIES.items():
-      if node.parent:
-        parent_field = node.parent.style[property]
-        parent_value = parent_field.read(notify=node.style[property])
-        new_style[property] = parent_value
-      else:
-        new_style[property] = default_value
-    for media, selector, body in rules:
-      if media:
-        if (media == "dark") != frame.tab.dark_mode: continue
-      if not selector.matches(node): continue
-      for property, value in body.items():
-        new_style[property] = value
-    if isinstance(node, Element) and "style" in node.attributes:
-      pairs = CSSParser(node.attributes["style"]).body()
-      for property, value in pairs.items():
-        new_style[property] = value
-    if new_style["font-size"].endswith("%"):
-      if node.parent:
-        parent_field = node.parent.style["font-size"]
-        parent_font_size = parent_field.read(notify=node.style["font-size"])
-      else:
-        parent_font_size = INHERITED_PROPERTIES["font-size"]
-      node_pct = float(new_style["font-size"][:-1]) / 100
-      parent_px = float(parent_font_size[:-2])
-      new_style["font-size"] = str(node_pct * parent_px) + "px"
+    old_style = node.style.current_values()
+    key = style_sharing_key(node)
+    if shared_styles is not None and key in shared_styles:
+      new_style = shared_styles[key]
+    else:
+      new_style = compute_style(node, rules, frame, ancestors)
+      if shared_styles is not None:
+        shared_styles[key] = new_style
 
     if old_style:
       transitions = diff_styles(old_style, new_style)
+      if transitions:
+        new_style = new_style.copy()
       for property, (old_value, new_value, num_frames) in transitions.items():
         if property == "opacity":
           frame.set_needs_render()
@@ -223,12 +262,65 @@ def style(node, rules, frame):
             old_value, new_value, num_frames
           )
           node.animations[property] = animation
-          node.style[property] = animation.animate()
-    for property, field in node.style.items():
-      field.set(new_style[property])
+          value = animation.animate()
+          if value:
+            new_style[property] = value
+    if old_style != new_style:
+      frame.invalidate_paint(node)
+      if old_style["transform"] and old_style["transform"] != new_style["transform"]:
+        frame.invalidate_hit_test(node)
+    node.style.set_values(new_style)
 
+  if not node.has_dirty_descendants: return
+  shared_styles = {}
+  ancestors.push(node)
   for child in node.children:
-    style(child, rules, frame)
+    style(child, rules, frame, ancestors, shared_styles)
+  ancestors.pop(node)
+  node.has_dirty_descendants = False
+
+def compute_style(node, rules, frame, ancestors):
+  new_style = CSS_PROPERTIES.copy()
+  for property, default_value in INHERITED_PROPERTIES.items():
+    if node.parent:
+      parent_field = node.parent.style[property]
+      parent_value = parent_field.read(notify=node.style[property])
+      new_style[property] = parent_value
+    else:
+      new_style[property] = default_value
+  for media, selector, body in rules:
+    if media:
+      if (media == "dark") != frame.tab.dark_mode: continue
+    if not selector.matches(node, ancestors): continue
+    for property, value in body.items():
+      new_style[property] = value
+  if isinstance(node, Element) and "style" in node.attributes:
+    pairs = parse_inline_style(node.attributes["style"])
+    for property, value in pairs.items():
+      new_style[property] = value
+  if new_style["font-size"].endswith("%"):
+    if node.parent:
+      parent_field = node.parent.style["font-size"]
+      parent_font_size = parent_field.read(notify=node.style["font-size"])
+    else:
+      parent_font_size = INHERITED_PROPERTIES["font-size"]
+    node_pct = float(new_style["font-size"][:-1]) / 100
+    parent_px = float(parent_font_size[:-2])
+    new_style["font-size"] = str(node_pct * parent_px) + "px"
+  return new_style
+
+@functools.lru_cache(maxsize=INLINE_STYLE_CACHE_SIZE)
+def parse_inline_style(s):
+  return CSSParser(s).body()
+
+# Siblings already share inherited values and ancestors.
+def style_sharing_key(node):
+  if isinstance(node, Element):
+    return (
+      node.tag, node.is_focused, node.attributes.get("id"),
+      node.attributes.get("class"), node.attributes.get("style"),
+    )
+  return (None, node.is_focused, None, None, None)
 
 def parse_transition(value):
   properties = {}
@@ -263,22 +355,30 @@ def map_translation(rect, translation, reversed=False):
     return rect
   else:
     (x, y) = translation
-    matrix = skia.Matrix()
     if reversed:
-      matrix.setTranslate(-x, -y)
+      return rect.makeOffset(-x, -y)
     else:
-      matrix.setTranslate(x, y)
-    return matrix.mapRect(rect)
+      return rect.makeOffset(x, y)
+
+def node_translation(node, translations=None):
+  if not node:
+    return 0, 0
+  if translations is not None and node in translations:
+    return translations[node]
+  dx, dy = node_translation(node.parent, translations)
+  translation = node.style["transform"].get_computed()
+  if translation:
+    dx += translation[0]
+    dy += translation[1]
+  if translations is not None:
+    translations[node] = (dx, dy)
+  return dx, dy
 
-def absolute_bounds_for_obj(obj):
-  rect = skia.Rect.MakeXYWH(
-    obj.x.get(), obj.y.get(), obj.width.get(), obj.height.get()
+def absolute_bounds_for_obj(obj, translations=None):
+  dx, dy = node_translation(obj.node, translations)
+  return skia.Rect.MakeXYWH(
+    obj.x.get() + dx, obj.y.get() + dy, obj.width.get(), obj.height.get()
   )
-  cur = obj.node
-  while cur:
-    rect = map_translation(rect, parse_transform(cur.style["transform"].get()))
-    cur = cur.parent
-  return rect
 
 def parse_outline(outline_str):
   if not outline_str: return None
@@ -287,16 +387,264 @@ def parse_outline(outline_str):
   if values[1] != "solid": return None
   return int(values[0][:-2]), values[2]
 
+def parse_px(value, default=0.0):
+  try:
+    return float(value[:-2])
+  except (TypeError, ValueError):
+    return default
+
+def resolve_font_size(value):
+  return parse_px(value, None)
+
+def resolve_background_color(value):
+  if value == "transparent": return None
+  return parse_color(value)
+
+def resolve_outline(value):
+  outline = parse_outline(value)
+  if not outline: return None
+  thickness, color = outline
+  return thickness, parse_color(color)
+
+COMPUTED_VALUE_RESOLVERS = {
+  "font-size": resolve_font_size,
+  "color": parse_color,
+  "opacity": float,
+  "transform": parse_transform,
+  "border-radius": parse_px,
+  "outline": resolve_outline,
+  "background-color": resolve_background_color,
+}
+
 def dirty_style(node):
+  if not node.style: return
   for property, value in node.style.items():
     value.mark()
 
-def init_style(node):
+def dirty_style_descendants(node):
+  while node and not node.has_dirty_descendants:
+    node.has_dirty_descendants = True
+    node = node.parent
+
+def init_style(node, store=None):
   from layout import ProtectedField
-  node.style = dict([
-    (property, ProtectedField(node, property, None,
-      [node.parent.style[property]] if node.parent and property in INHERITED_PROPERTIES else []))
+  if store is not None:
+    node.style = store.add(node)
+    return
+  node.style = FieldStyle([
+    (property, ProtectedField(node, property, node.parent,
+      [node.parent.style[property]] if node.parent and property in INHERITED_PROPERTIES else [],
+      COMPUTED_VALUE_RESOLVERS.get(property)))
     for property in CSS_PROPERTIES
   ])
 
+class FieldStyle(dict):
+  def is_dirty(self):
+    return any([field.dirty for field in self.values()])
+
+  def current_values(self):
+    return dict([
+      (property, field.value)
+      for property, field in self.items()
+    ])
+
+  def set_values(self, new_style):
+    for property, field in self.items():
+      field.set(new_style[property])
+
+STYLE_PROPERTIES = list(CSS_PROPERTIES)
+STYLE_PROPERTY_IDS = dict([
+  (property, i) for i, property in enumerate(STYLE_PROPERTIES)
+])
+
+class StyleStore:
+  PROPERTIES = STYLE_PROPERTIES
+  PROPERTY_IDS = STYLE_PROPERTY_IDS
+  INHERITED_IDS = set([STYLE_PROPERTY_IDS[property] for property in INHERITED_PROPERTIES])
+  RESOLVERS = [COMPUTED_VALUE_RESOLVERS.get(property) for property in STYLE_PROPERTIES]
+
+  def __init__(self):
+    self.nodes = []
+    self.values = []
+    self.computed = []
+    self.dirty = bytearray()
+    self.fields = []
+    self.observers = {}
+    self.free = []
+
+  def add(self, node):
+    num_properties = len(self.PROPERTIES)
+    if self.free:
+      base = self.free.pop()
+      self.nodes[base // num_properties] = node
+      return NodeStyle(self, base)
+    base = len(self.nodes) * num_properties
+    self.nodes.append(node)
+    self.values.extend([None] * num_properties)
+    self.computed.extend([None] * num_properties)
+    self.dirty.extend(b"\x01" * num_properties)
+    self.fields.extend([None] * num_properties)
+    return NodeStyle(self, base)
+
+  def release(self, nodes):
+    num_properties = len(self.PROPERTIES)
+    for node in nodes:
+      if not isinstance(node.style, NodeStyle) or node.style.store is not self:
+        continue
+      base = node.style.base
+      for slot in range(base, base + num_properties):
+        self.values[slot] = None
+        self.computed[slot] = None
+        self.dirty[slot] = 1
+        self.observers.pop(slot, None)
+      self.nodes[base // num_properties] = None
+      self.free.append(base)
+      node.style = None
+
+  def field(self, slot):
+    field = self.fields[slot]
+    if field is None:
+      field = self.fields[slot] = StyleField(self, slot)
+    return field
+
+  def mark(self, slot):
+    if self.dirty[slot]: return
+    self.dirty[slot] = 1
+    self.set_ancestor_dirty_flags(slot)
+
+  def set(self, slot, value):
+    if value != self.values[slot]:
+      self.notify(slot)
+      resolve = self.RESOLVERS[slot % len(self.PROPERTIES)]
+      if resolve:
+        self.computed[slot] = resolve(value)
+    self.values[slot] = value
+    self.dirty[slot] = 0
+
+  def notify(self, slot):
+    for field in self.observers.get(slot, ()):
+      field.mark()
+    node_id, property_id = divmod(slot, len(self.PROPERTIES))
+    if property_id in self.INHERITED_IDS:
+      for child in self.nodes[node_id].children:
+        if child.style:
+          self.mark(child.style.base + property_id)
+    self.set_ancestor_dirty_flags(slot)
+
+  def set_ancestor_dirty_flags(self, slot):
+    parent = self.nodes[slot // len(self.PROPERTIES)].parent
+    while parent and not parent.has_dirty_descendants:
+      parent.has_dirty_descendants = True
+      parent = parent.parent
+
+  def __repr__(self):
+    return "StyleStore(nodes={}, free={})".format(len(self.nodes), len(self.free))
+
+class NodeStyle:
+  __slots__ = ("store", "base")
+
+  def __init__(self, store, base):
+    self.store = store
+    self.base = base
+
+  def __getitem__(self, property):
+    return self.store.field(self.base + StyleStore.PROPERTY_IDS[property])
+
+  def __contains__(self, property):
+    return property in StyleStore.PROPERTY_IDS
+
+  def __iter__(self):
+    return iter(StyleStore.PROPERTIES)
+
+  def __len__(self):
+    return len(StyleStore.PROPERTIES)
+
+  def keys(self):
+    return list(StyleStore.PROPERTIES)
+
+  def is_dirty(self):
+    return any(self.store.dirty[self.base:self.base + len(self)])
+
+  def current_values(self):
+    return dict(zip(
+      StyleStore.PROPERTIES, self.store.values[self.base:self.base + len(self)]
+    ))
+
+  def set_values(self, new_style):
+    for i, property in enumerate(StyleStore.PROPERTIES):
+      self.store.set(self.base + i, new_style[property])
+
+  def values(self):
+    return [self.store.field(self.base + i) for i in range(len(self))]
+
+  def items(self):
+    return [
+      (property, self.store.field(self.base + i))
+      for i, property in enumerate(StyleStore.PROPERTIES)
+    ]
+
+class StyleField:
+  __slots__ = ("store", "slot")
+  frozen_dependencies = True
+
+  def __init__(self, store, slot):
+    self.store = store
+    self.slot = slot
+
+  @property
+  def dirty(self):
+    return bool(self.store.dirty[self.slot])
+
+  @property
+  def value(self):
+    return self.store.values[self.slot]
+
+  @property
+  def computed(self):
+    return self.store.computed[self.slot]
+
+  @property
+  def invalidations(self):
+    return self.store.observers.setdefault(self.slot, set())
+
+  def mark(self):
+    self.store.mark(self.slot)
+
+  def notify(self):
+    self.store.notify(self.slot)
+
+  def get(self):
+    assert not self.dirty
+    return self.value
+
+  def get_computed(self):
+    assert not self.dirty
+    return self.computed
+
+  def read(self, notify):
+    if not isinstance(notify, StyleField):
+      if notify.frozen_dependencies:
+        assert notify in self.invalidations
+      else:
+        self.invalidations.add(notify)
+    return self.get()
+
+  def read_computed(self, notify):
+    self.read(notify)
+    return self.computed
+
+  def set(self, value):
+    self.store.set(self.slot, value)
+
+  def __eq__(self, other):
+    return isinstance(other, StyleField) and self.store is other.store and self.slot == other.slot
+
+  def __hash__(self):
+    return hash((id(self.store), self.slot))
+
+  def __repr__(self):
+    node_id, property_id = divmod(self.slot, len(StyleStore.PROPERTIES))
+    return "StyleField({}, {})".format(
+      self.store.nodes[node_id], StyleStore.PROPERTIES[property_id])
+
 DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
\ No newline at end of file
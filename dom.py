@@ -1,21 +1,21 @@
 import html
 
 def print_tree(node, indent=0):
-  from layout import ProtectedField
+  from layout import ProtectedField, GraphField
 
   print(' ' * indent, node)
   children = node.children
-  if isinstance(children, ProtectedField):
+  if isinstance(children, (ProtectedField, GraphField)):
     children = children.get()
   for child in children:
     print_tree(child, indent + 2)
 
 def tree_to_list(tree, list):
-  from layout import ProtectedField
+  from layout import ProtectedField, GraphField
 
   list.append(tree)
   children = tree.children
-  if isinstance(children, ProtectedField):
+  if isinstance(children, (ProtectedField, GraphField)):
     children = children.get()
 
   for child in children:
@@ -31,6 +31,7 @@ class Text:
     self.is_focused = False
     self.animations = {}
     self.layout_object = None
+    self.has_dirty_descendants = True
   
   def __repr__(self):
     return repr(self.text)
@@ -45,6 +46,7 @@ class Element:
     self.is_focused = False
     self.animations = {}
     self.layout_object = None
+    self.has_dirty_descendants = True
 
   def __repr__(self):
     return "<" + self.tag + ">"
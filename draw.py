@@ -1,8 +1,17 @@
+import collections
+import functools
+import math
 import skia
-from constants import NAMED_COLORS, SHOW_COMPOSITED_LAYER_BORDERS
+import threading
+from constants import NAMED_COLORS, SHOW_COMPOSITED_LAYER_BORDERS, TEXT_WIDTH_CACHE_SIZE, COLOR_CACHE_SIZE, FONT_CACHE_SIZE, RECORD_LAYER_PICTURES, TEXT_BLOB_BATCHING, TILE_SIZE, TILE_PREFETCH_MARGIN, TILE_CACHE_BYTES
 
 FONTS = {}
+FONT_LOCK = threading.Lock()
+TYPEFACES = {}
+PAINTS = {}
+SAMPLING_OPTIONS = {}
 
+@functools.lru_cache(maxsize=COLOR_CACHE_SIZE)
 def parse_color(color):
   if color.startswith("#") and len(color) == 7:
     r = int(color[1:3], 16)
@@ -39,14 +48,48 @@ def parse_blend_mode(blend_mode_str):
     return skia.BlendMode.kSrcOver
 
 def parse_image_rendering(quality):
-  if quality == "high-quality":
-    return skia.SamplingOptions(skia.CubicResampler.Mitchell())
-  elif quality == "crisp-edges":
-    return skia.SamplingOptions(skia.FilterMode.kNearest, skia.MipmapMode.kNone)
-  else:
-    return skia.SamplingOptions(skia.FilterMode.kLinear, skia.MipmapMode.kLinear)
+  if quality not in SAMPLING_OPTIONS:
+    if quality == "high-quality":
+      options = skia.SamplingOptions(skia.CubicResampler.Mitchell())
+    elif quality == "crisp-edges":
+      options = skia.SamplingOptions(skia.FilterMode.kNearest, skia.MipmapMode.kNone)
+    else:
+      options = skia.SamplingOptions(skia.FilterMode.kLinear, skia.MipmapMode.kLinear)
+    SAMPLING_OPTIONS[quality] = options
+  return SAMPLING_OPTIONS[quality]
+
+def get_paint(color, style=None, stroke_width=0, antialias=False):
+  key = (color, style, stroke_width, antialias)
+  if key not in PAINTS:
+    paint = skia.Paint(Color=color, AntiAlias=antialias)
+    if style is not None:
+      paint.setStyle(style)
+      paint.setStrokeWidth(stroke_width)
+    PAINTS[key] = paint
+  return PAINTS[key]
+
+class FontInfo:
+  def __init__(self, typeface, size):
+    self.font = skia.Font(typeface, size)
+    self.typeface_id = typeface.uniqueID()
+    self.size = self.font.getSize()
+    metrics = self.font.getMetrics()
+    self.ascent = metrics.fAscent
+    self.descent = metrics.fDescent
+    self.linespace = self.descent - self.ascent
+    self.space_width = self.font.measureText(" ")
+
+  def __eq__(self, other):
+    return isinstance(other, FontInfo) and \
+      (self.typeface_id, self.size) == (other.typeface_id, other.size)
+
+  def __hash__(self):
+    return hash((self.typeface_id, self.size))
 
-def get_font(size, weight, style):
+  def __repr__(self):
+    return "FontInfo(size={})".format(self.size)
+
+def get_typeface(weight, style):
   key = (weight, style)
   if key not in FONTS:
     if weight == "bold":
@@ -61,25 +104,36 @@ def get_font(size, weight, style):
     style_info = skia.FontStyle(skia_weight, skia_width, skia_style)
     font = skia.Typeface('Arial', style_info)
     FONTS[key] = font
-  return skia.Font(FONTS[key], size)
+    TYPEFACES[font.uniqueID()] = font
+  return FONTS[key]
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(size, weight, style):
+  FONT_LOCK.acquire(blocking=True)
+  font = FontInfo(get_typeface(weight, style), size)
+  FONT_LOCK.release()
+  return font
+
+@functools.lru_cache(maxsize=TEXT_WIDTH_CACHE_SIZE)
+def text_width(typeface_id, size, text):
+  return skia.Font(TYPEFACES[typeface_id], size).measureText(text)
+
+def measure_text(font, text):
+  return text_width(font.typeface_id, font.size, text)
 
 def font(css_style, zoom, notify):
   from layout import dpx
 
   weight = css_style["font-weight"].read(notify)
   style = css_style["font-style"].read(notify)
-  size = None
-  try:
-    size = float(css_style["font-size"].read(notify)[:-2]) * 0.75
-  except:
+  size = css_style["font-size"].read_computed(notify)
+  if size is None:
     size = 16
+  else:
+    size *= 0.75
   font_size = dpx(size, zoom)
   return get_font(font_size, weight, style)
 
-def linespace(font):
-  metrics = font.getMetrics()
-  return metrics.fDescent - metrics.fAscent
-
 def local_to_absolute(display_item, rect):
   while display_item.parent:
     rect = display_item.parent.map(rect)
@@ -95,18 +149,37 @@ def absolute_to_local(display_item, rect):
     rect = parent.unmap(rect)
   return rect
 
+def batch_text(items):
+  batched = []
+  run = []
+  for item in items + [None]:
+    if isinstance(item, DrawText) and run and item.paint is run[0].paint:
+      run.append(item)
+      continue
+    if len(run) == 1:
+      batched.append(run[0])
+    elif run:
+      batched.append(DrawTextBlob(run))
+    run = []
+    if isinstance(item, DrawText):
+      run.append(item)
+    elif isinstance(item, VisualEffect):
+      batched.append(item.copy(batch_text(item.children)))
+    elif item:
+      batched.append(item)
+  return batched
+
 def paint_outline(node, cmds, rect, zoom):
   from layout import dpx
-  from css import parse_outline
 
-  outline = parse_outline(node.style["outline"].get())
+  outline = node.style["outline"].get_computed()
   if not outline: return
   thickness, color = outline
   cmds.append(DrawOutline(rect, color, dpx(thickness, zoom)))
 
 def DrawCursor(elt, offset):
     x = elt.x.get() + offset
-    return DrawLine(x, elt.y.get(), x, elt.y.get() + elt.height.get(), "red", 1)
+    return DrawLine(x, elt.y.get(), x, elt.y.get() + elt.height.get(), skia.ColorRED, 1)
 
 class PaintCommand:
   def __init__(self, rect):
@@ -125,61 +198,176 @@ class VisualEffect:
       if isinstance(child, VisualEffect)
     ])
 
+class TileCache:
+  def __init__(self, budget):
+    self.budget = budget
+    self.size = 0
+    self.tiles = collections.OrderedDict()
+    self.in_use = set()
+    self.missing = []
+
+  def begin_frame(self):
+    self.in_use = set()
+
+  def has_room(self):
+    return self.size < self.budget
+
+  def get(self, key):
+    surface = self.tiles.get(key)
+    if surface:
+      self.tiles.move_to_end(key)
+      self.in_use.add(key)
+    return surface
+
+  def put(self, key, surface):
+    self.tiles[key] = surface
+    self.in_use.add(key)
+    self.size += surface.width() * surface.height() * 4
+    while self.size > self.budget:
+      oldest = next(iter(self.tiles))
+      if oldest in self.in_use: break
+      evicted = self.tiles.pop(oldest)
+      self.size -= evicted.width() * evicted.height() * 4
+
+TILE_CACHE = TileCache(TILE_CACHE_BYTES)
+
 class CompositedLayer:
   def __init__(self, skia_context, display_item):
     self.skia_context = skia_context
-    self.surface = None
+    self.content = object()
+    self.bounds = None
+    self.picture = None
+    self.raster_items = None
     self.display_items = [display_item]
     self.parent = display_item.parent
+    self.absolute_rect = skia.Rect.MakeEmpty()
+    self.absolute_rect.join(local_to_absolute(display_item, display_item.rect))
+    self.effects = None
+    self.drawn_rect = None
 
   def composited_bounds(self):
-    rect = skia.Rect.MakeEmpty()
-    for item in self.display_items:
-      rect.join(absolute_to_local(
-        item, local_to_absolute(item, item.rect)
-      ))
-    rect.outset(1, 1)
-    return rect
+    if self.bounds is None:
+      rect = skia.Rect.MakeEmpty()
+      for item in self.display_items:
+        rect.join(absolute_to_local(
+          item, local_to_absolute(item, item.rect)
+        ))
+      rect.outset(1, 1)
+      self.bounds = skia.Rect.Make(rect.roundOut())
+    return self.bounds
   
-  def raster(self):
+  def reuse(self, old_layer):
+    if self.composited_bounds() != old_layer.composited_bounds(): return False
+    self.content = old_layer.content
+    self.picture = old_layer.picture
+    self.raster_items = old_layer.raster_items
+    return True
+
+  def tiles_in(self, rect):
     bounds = self.composited_bounds()
-    if bounds.isEmpty(): return
-    irect = bounds.roundOut()
-
-    if not self.surface:
-      self.surface = skia.Surface.MakeRenderTarget(
-        self.skia_context, skia.Budgeted.kNo,
-        skia.ImageInfo.MakeN32Premul(
-          irect.width(), irect.height())
-      )
-      if not self.surface:
-        self.surface = skia.Surface(irect.width(), irect.height())
-      assert self.surface
+    area = skia.Rect.MakeEmpty()
+    area.join(rect)
+    if not area.intersect(bounds): return []
+    tiles = []
+    for row in range(
+      math.floor((area.top() - bounds.top()) / TILE_SIZE),
+      math.ceil((area.bottom() - bounds.top()) / TILE_SIZE)):
+      for column in range(
+        math.floor((area.left() - bounds.left()) / TILE_SIZE),
+        math.ceil((area.right() - bounds.left()) / TILE_SIZE)):
+        tile_rect = skia.Rect.MakeXYWH(
+          bounds.left() + column * TILE_SIZE, bounds.top() + row * TILE_SIZE,
+          TILE_SIZE, TILE_SIZE)
+        tile_rect.intersect(bounds)
+        tiles.append(((self.content, column, row), tile_rect))
+    return tiles
+
+  def raster(self, viewport):
+    bounds = self.composited_bounds()
+    if bounds.isEmpty(): return 0
+    visible = absolute_to_local(self.display_items[0], viewport)
+    prefetch = visible.makeOutset(0, TILE_PREFETCH_MARGIN)
+    rastered = 0
+    for key, rect in self.tiles_in(visible):
+      if TILE_CACHE.get(key): continue
+      TILE_CACHE.put(key, self.raster_tile(rect))
+      rastered += 1
+    for key, rect in self.tiles_in(prefetch):
+      if TILE_CACHE.get(key): continue
+      if not TILE_CACHE.has_room(): break
+      TILE_CACHE.put(key, self.raster_tile(rect))
+      rastered += 1
+    return rastered
+
+  def raster_tile(self, rect):
+    irect = rect.roundOut()
+    surface = skia.Surface.MakeRenderTarget(
+      self.skia_context, skia.Budgeted.kNo,
+      skia.ImageInfo.MakeN32Premul(irect.width(), irect.height())
+    )
+    if not surface:
+      surface = skia.Surface(irect.width(), irect.height())
+    assert surface
 
-    canvas = self.surface.getCanvas()
+    canvas = surface.getCanvas()
     canvas.clear(skia.ColorTRANSPARENT)
     canvas.save()
-    canvas.translate(-bounds.left(), -bounds.top())
-    for item in self.display_items:
-      item.execute(canvas)
+    canvas.translate(-rect.left(), -rect.top())
+    if RECORD_LAYER_PICTURES:
+      canvas.drawPicture(self.record(self.composited_bounds()))
+    else:
+      canvas.clipRect(rect)
+      for item in self.get_raster_items():
+        item.execute(canvas)
     canvas.restore()
 
     if SHOW_COMPOSITED_LAYER_BORDERS:
       border_rect = skia.Rect.MakeXYWH(1, 1, irect.width() - 2, irect.height() - 2)
-      DrawOutline(border_rect, "red", 1).execute(canvas)
+      DrawOutline(border_rect, skia.ColorRED, 1).execute(canvas)
+    return surface
+
+  def get_raster_items(self):
+    if self.raster_items is None:
+      if TEXT_BLOB_BATCHING:
+        self.raster_items = batch_text(self.display_items)
+      else:
+        self.raster_items = self.display_items
+    return self.raster_items
+
+  def record(self, bounds):
+    if not self.picture:
+      recorder = skia.PictureRecorder()
+      canvas = recorder.beginRecording(bounds, skia.RTreeFactory()())
+      for item in self.get_raster_items():
+        item.execute(canvas)
+      self.picture = recorder.finishRecordingAsPicture()
+    return self.picture
 
   def add(self, display_item):
     assert self.can_merge(display_item)
     self.display_items.append(display_item)
+    self.absolute_rect.join(local_to_absolute(display_item, display_item.rect))
+    self.bounds = None
+    self.picture = None
+    self.raster_items = None
 
   def can_merge(self, display_item):
     return display_item.parent == self.display_items[0].parent
   
   def absolute_bounds(self):
-    rect = skia.Rect.MakeEmpty()
-    for item in self.display_items:
-      rect.join(local_to_absolute(item, item.rect))
-    return rect
+    return self.absolute_rect
+
+  def drawn_bounds(self):
+    return local_to_absolute(self.display_items[0], self.composited_bounds())
+
+  def effect_chain(self):
+    chain = []
+    parent = self.parent
+    while parent:
+      chain.append((parent, getattr(parent, "opacity", None),
+        getattr(parent, "blend_mode", None), getattr(parent, "translation", None)))
+      parent = parent.parent
+    return tuple(chain)
 
   def __repr__(self):
     return ("layer: composited_bounds={} absolute_bounds={} first_chunk={}").format(
@@ -193,9 +381,12 @@ class DrawCompositedLayer(PaintCommand):
 
   def execute(self, canvas):
     layer = self.composited_layer
-    if not layer.surface: return
-    bounds = layer.composited_bounds()
-    layer.surface.draw(canvas, bounds.left(), bounds.top())
+    for key, rect in layer.tiles_in(canvas.getLocalClipBounds()):
+      surface = TILE_CACHE.get(key)
+      if surface:
+        surface.draw(canvas, rect.left(), rect.top())
+      else:
+        TILE_CACHE.missing.append(canvas.getTotalMatrix().mapRect(rect))
 
   def __repr__(self):
     return "DrawCompositedLayer()"
@@ -205,34 +396,50 @@ class DrawText(PaintCommand):
     self.font = font
     self.text = text
     self.color = color
+    self.paint = get_paint(color, antialias=True)
     super().__init__(skia.Rect.MakeLTRB(
       x1, y1,
-      x1 + font.measureText(text),
-      y1 - font.getMetrics().fAscent + font.getMetrics().fDescent
+      x1 + measure_text(font, text),
+      y1 + font.linespace
     ))
 
   def execute(self, canvas):
-    paint = skia.Paint(
-      AntiAlias=True,
-      Color=parse_color(self.color)
-    )
-    baseline = self.rect.top() - self.font.getMetrics().fAscent
-    canvas.drawString(self.text, float(self.rect.left()), baseline, self.font, paint)
+    baseline = self.rect.top() - self.font.ascent
+    canvas.drawString(self.text, float(self.rect.left()), baseline, self.font.font, self.paint)
 
   def __repr__(self):
     return "DrawText(text={})".format(self.text)
 
+class DrawTextBlob(PaintCommand):
+  def __init__(self, texts):
+    rect = skia.Rect.MakeEmpty()
+    builder = skia.TextBlobBuilder()
+    for text in texts:
+      rect.join(text.rect)
+      if not text.text: continue
+      baseline = text.rect.top() - text.font.ascent
+      builder.allocRun(text.text, text.font.font, float(text.rect.left()), baseline)
+    super().__init__(rect)
+    self.blob = builder.make()
+    self.paint = texts[0].paint
+    self.count = len(texts)
+
+  def execute(self, canvas):
+    if self.blob:
+      canvas.drawTextBlob(self.blob, 0, 0, self.paint)
+
+  def __repr__(self):
+    return "DrawTextBlob(count={})".format(self.count)
+
 class DrawRect(PaintCommand):
   def __init__(self, rect, color):
     super().__init__(rect)
     self.rect = rect
     self.color = color
+    self.paint = get_paint(color)
 
   def execute(self, canvas):
-    paint = skia.Paint(
-      Color=parse_color(self.color),
-    )
-    canvas.drawRect(self.rect, paint)
+    canvas.drawRect(self.rect, self.paint)
 
   def __repr__(self):
     return "DrawRect(top={} left={} bottom={} right={} color={})".format(
@@ -244,12 +451,10 @@ class DrawRRect(PaintCommand):
     super().__init__(rect)
     self.rrect = skia.RRect.MakeRectXY(rect, radius, radius)
     self.color = color
+    self.paint = get_paint(color)
 
   def execute(self, canvas):
-    paint = skia.Paint(
-      Color=parse_color(self.color),
-    )
-    canvas.drawRRect(self.rrect, paint)
+    canvas.drawRRect(self.rrect, self.paint)
   
   def __repr__(self):
     return "DrawRRect(rect={}, color={})".format(
@@ -261,17 +466,13 @@ class DrawLine(PaintCommand):
     super().__init__(skia.Rect.MakeLTRB(x1, y1, x2, y2))
     self.color = color
     self.thickness = thickness
+    self.paint = get_paint(color, skia.Paint.kStroke_Style, thickness)
 
   def execute(self, canvas):
     path = skia.Path().moveTo(
       self.rect.left(), self.rect.top()
     ).lineTo(self.rect.right(), self.rect.bottom())
-    paint = skia.Paint(
-      Color=parse_color(self.color),
-      StrokeWidth=self.thickness,
-      Style=skia.Paint.kStroke_Style,
-    )
-    canvas.drawPath(path, paint)
+    canvas.drawPath(path, self.paint)
   
   def __repr__(self):
     return "DrawLine(top={} left={} bottom={} right={})".format(
@@ -283,14 +484,10 @@ class DrawOutline(PaintCommand):
     super().__init__(rect)
     self.color = color
     self.thickness = thickness
+    self.paint = get_paint(color, skia.Paint.kStroke_Style, thickness)
 
   def execute(self, canvas):
-    paint = skia.Paint(
-      Color=parse_color(self.color),
-      StrokeWidth=self.thickness,
-      Style=skia.Paint.kStroke_Style,
-    )
-    canvas.drawRect(self.rect, paint) 
+    canvas.drawRect(self.rect, self.paint)
 
   def __repr__(self):
     return "DrawOutline(top={} left={} bottom={} right={} border_color={} thickness={})".format(
@@ -318,6 +515,10 @@ class Blend(VisualEffect):
 
     if self.should_save:
       self.needs_compositing = True
+      self.paint = skia.Paint(
+        Alphaf=self.opacity,
+        BlendMode=parse_blend_mode(self.blend_mode),
+      )
 
     self.children = children
     self.rect = skia.Rect.MakeEmpty()
@@ -325,19 +526,18 @@ class Blend(VisualEffect):
       self.rect.join(cmd.rect)
 
   def execute(self, canvas):
-    paint = skia.Paint(
-      Alphaf=self.opacity,
-      BlendMode=parse_blend_mode(self.blend_mode),
-    )
     if self.should_save:
-      canvas.saveLayer(None, paint)
+      canvas.saveLayer(None, self.paint)
     for cmd in self.children:
       cmd.execute(canvas)
     if self.should_save:
       canvas.restore()
 
   def clone(self, child):
-    return Blend(self.opacity, self.blend_mode, self.node, [child])
+    return self.copy([child])
+
+  def copy(self, children):
+    return Blend(self.opacity, self.blend_mode, self.node, children)
   
   def map(self, rect):
     if self.children and isinstance(self.children[-1], Blend) and self.children[-1].blend_mode == "destination-in":
@@ -377,7 +577,10 @@ class Transform(VisualEffect):
       canvas.restore()
 
   def clone(self, child):
-    return Transform(self.translation, self.self_rect, self.node, [child])
+    return self.copy([child])
+
+  def copy(self, children):
+    return Transform(self.translation, self.self_rect, self.node, children)
   
   def map(self, rect):
     from css import map_translation
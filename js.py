@@ -1,6 +1,6 @@
 import dukpy
 import threading
-from css import CSSParser, dirty_style
+from css import CSSParser, dirty_style, dirty_style_descendants
 from dom import tree_to_list, HTMLParser
 from task import Task
 from layout import BlockLayout, IframeLayout, ImageLayout
@@ -84,6 +84,7 @@ class JSContext:
       if attr == "width" or attr == "height":
         obj.width.mark()
         obj.height.mark()
+    frame.invalidate_paint(elt)
     self.tab.set_needs_render_all_frames()
 
   def dispatch_event(self, type, elt, window_id):
@@ -100,14 +101,24 @@ class JSContext:
     doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
     new_nodes = doc.children[0].children
     elt = self.handle_to_node[handle]
+    if frame.style_store:
+      removed = []
+      for child in elt.children:
+        tree_to_list(child, removed)
+      frame.style_store.release(removed)
     elt.children = new_nodes
     for child in elt.children:
       child.parent = elt
-    obj = elt.layout_object
+    dirty_style_descendants(elt)
+    node = elt
+    while node and not node.layout_object:
+      node = node.parent
+    obj = node.layout_object if node else None
     if obj:
       while not isinstance(obj, BlockLayout):
         obj = obj.parent
       obj.children.mark()
+    frame.invalidate_paint(elt)
     frame.set_needs_render()
 
   def XMLHttpRequest_send(self, method, url, body, isasync, handle, window_id):
@@ -155,6 +166,7 @@ class JSContext:
     frame = self.tab.window_id_to_frame[window_id]
     self.throw_if_cross_origin(frame)
     elt = self.handle_to_node[handle]
+    if elt.attributes.get("style") == s: return
     elt.attributes["style"] = s
     dirty_style(elt)
     frame.set_needs_render()
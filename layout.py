@@ -1,8 +1,8 @@
+import math
 import skia
-from constants import BLOCK_ELEMENTS, HSTEP, VSTEP, INPUT_WIDTH_PX, IFRAME_HEIGHT_PX, IFRAME_WIDTH_PX, CSS_PROPERTIES
+from constants import BLOCK_ELEMENTS, HSTEP, VSTEP, INPUT_WIDTH_PX, IFRAME_HEIGHT_PX, IFRAME_WIDTH_PX, CSS_PROPERTIES, TEXT_RUN_LAYOUT, HIT_TEST_CELL_SIZE, PAINT_CACHE, LAYOUT_FIELD_GRAPH
 from dom import Text, tree_to_list
-from draw import DrawRRect, DrawText, linespace, Blend, Transform, paint_outline, DrawImage, font, DrawCursor
-from css import parse_transform, parse_outline
+from draw import DrawRRect, DrawText, Blend, Transform, paint_outline, DrawImage, font, DrawCursor, measure_text
 
 def print_composited_layers(composited_layers):
   print("Composited layers:")
@@ -15,12 +15,16 @@ def add_parent_pointers(nodes, parent=None):
     add_parent_pointers(node.children, node)
 
 def paint_tree(layout_object, display_list):
+  if PAINT_CACHE and not layout_object.paint_dirty:
+    display_list.extend(layout_object.paint_cache)
+    return
+
   cmds = layout_object.paint()
 
   if isinstance(layout_object, IframeLayout) and layout_object.node.frame and layout_object.node.frame.loaded:
     paint_tree(layout_object.node.frame.document, cmds)
   else:
-    if isinstance(layout_object.children, ProtectedField):
+    if isinstance(layout_object.children, (ProtectedField, GraphField)):
       for child in layout_object.children.get():
         paint_tree(child, cmds)
     else:
@@ -28,28 +32,141 @@ def paint_tree(layout_object, display_list):
         paint_tree(child, cmds)
 
   cmds = layout_object.paint_effects(cmds)
+  layout_object.paint_cache = cmds
+  layout_object.paint_dirty = False
   display_list.extend(cmds)
 
+def paint_parent(layout_object):
+  if layout_object.parent:
+    return layout_object.parent
+  frame = layout_object.frame
+  if frame and frame.parent_frame:
+    return frame.frame_element.layout_object
+  return None
+
+def invalidate_paint(layout_object):
+  layout_object.paint_dirty = True
+  parent = paint_parent(layout_object)
+  while parent and not parent.paint_dirty:
+    parent.paint_dirty = True
+    parent = paint_parent(parent)
+
 def paint_visual_effects(node, cmds, rect):
-  opacity = float(node.style["opacity"].get())
+  opacity = node.style["opacity"].get_computed()
   blend_mode = node.style["mix-blend-mode"].get()
-  translation = parse_transform(node.style["transform"].get())
+  translation = node.style["transform"].get_computed()
 
   if node.style["overflow"].get() == "clip":
-    border_radius = float(node.style["border-radius"].get()[:-2])
+    border_radius = node.style["border-radius"].get_computed()
     if not blend_mode:
       blend_mode = "source-over"
-    cmds = [Blend(1.0, "source-over", node, cmds + [Blend(1.0, "destination-in", None, [DrawRRect(rect, 0, "white")])])]
+    cmds = [Blend(1.0, "source-over", node, cmds + [Blend(1.0, "destination-in", None, [DrawRRect(rect, 0, skia.ColorWHITE)])])]
 
-  blend_op = Blend(opacity, blend_mode, node, cmds)
+  if opacity < 1 or blend_mode or "opacity" in node.animations:
+    blend_op = Blend(opacity, blend_mode, node, cmds)
+    cmds = [blend_op]
+  else:
+    blend_op = None
   node.blend_op = blend_op
-  return [Transform(translation, rect, node, [blend_op])]
+  if translation:
+    cmds = [Transform(translation, rect, node, cmds)]
+  return cmds
+
+class SpatialIndex:
+  def __init__(self, cell_size=HIT_TEST_CELL_SIZE):
+    self.cell_size = cell_size
+    self.cells = {}
+    self.bounds = {}
+    self.entries = {}
+    self.count = 0
+
+  def cell_range(self, rect):
+    return (
+      range(math.floor(rect.left() / self.cell_size), math.floor(rect.right() / self.cell_size) + 1),
+      range(math.floor(rect.top() / self.cell_size), math.floor(rect.bottom() / self.cell_size) + 1),
+    )
+
+  def insert(self, rect, item):
+    entry = (self.count, rect, item)
+    self.count += 1
+    self.bounds.setdefault(item, rect)
+    self.entries.setdefault(item, entry)
+    if rect.isEmpty(): return
+    columns, rows = self.cell_range(rect)
+    self.add_cells(entry, columns, rows)
+
+  def add_cells(self, entry, columns, rows):
+    for column in columns:
+      for row in rows:
+        self.cells.setdefault((column, row), []).append(entry)
+
+  def grow(self, item, rect):
+    bounds = self.bounds[item]
+    if rect.isEmpty() or bounds.contains(rect): return
+    if bounds.isEmpty():
+      old_columns, old_rows = range(0), range(0)
+    else:
+      old_columns, old_rows = self.cell_range(bounds)
+    bounds.join(rect)
+    columns, rows = self.cell_range(bounds)
+    entry = self.entries[item]
+    if not old_rows:
+      self.add_cells(entry, columns, rows)
+      return
+    self.add_cells(entry, columns, range(rows.start, old_rows.start))
+    self.add_cells(entry, columns, range(old_rows.stop, rows.stop))
+    self.add_cells(entry, range(columns.start, old_columns.start), old_rows)
+    self.add_cells(entry, range(old_columns.stop, columns.stop), old_rows)
+
+  def remove(self, item):
+    entry = self.entries.pop(item)
+    bounds = self.bounds.pop(item)
+    if bounds.isEmpty(): return
+    columns, rows = self.cell_range(bounds)
+    for column in columns:
+      for row in rows:
+        cell = self.cells[(column, row)]
+        cell.remove(entry)
+        if not cell:
+          del self.cells[(column, row)]
+
+  def update(self, item, rect):
+    if item in self.entries:
+      self.remove(item)
+    self.insert(rect, item)
+
+  def query(self, rect):
+    best = None
+    columns, rows = self.cell_range(rect)
+    for column in columns:
+      for row in rows:
+        for entry in self.cells.get((column, row), []):
+          if best is not None and entry[0] <= best[0]: continue
+          if skia.Rect.Intersects(entry[1], rect):
+            best = entry
+    return best[2] if best else None
+
+  def hits(self, x, y, contains=False):
+    point = skia.Rect.MakeXYWH(x, y, 1, 1)
+    hits = []
+    columns, rows = self.cell_range(point)
+    for column in columns:
+      for row in rows:
+        for entry in self.cells.get((column, row), []):
+          rect = entry[1]
+          if rect.contains(x, y) if contains else rect.intersects(point):
+            hits.append(entry)
+    return hits
+
+  def hit_test(self, x, y, contains=False):
+    hits = self.hits(x, y, contains)
+    return max(hits)[2] if hits else None
 
 def dpx(css_px, zoom):
   return css_px * zoom
 
 class ProtectedField:
-  def __init__(self, obj, name, parent=None, dependencies=None):
+  def __init__(self, obj, name, parent=None, dependencies=None, resolve=None):
     self.obj = obj
     self.name = name
     self.parent = parent
@@ -57,6 +174,8 @@ class ProtectedField:
     self.value = None
     self.dirty = True
     self.invalidations = set()
+    self.resolve = resolve
+    self.computed = None
 
     self.frozen_dependencies = (dependencies != None)
     if dependencies != None:
@@ -72,18 +191,28 @@ class ProtectedField:
     assert not self.dirty
     return self.value
   
+  def get_computed(self):
+    assert not self.dirty
+    return self.computed
+
   def read(self, notify):
     if notify.frozen_dependencies:
       assert notify in self.invalidations
     else:
       self.invalidations.add(notify)
     return self.get()
+
+  def read_computed(self, notify):
+    self.read(notify)
+    return self.computed
   
   def set(self, value):
     # if self.value != None:
     #   print("Change", self)
     if value != self.value:
       self.notify()
+      if self.resolve:
+        self.computed = self.resolve(value)
     self.value = value
     self.dirty = False
 
@@ -109,22 +238,218 @@ class ProtectedField:
   def __repr__(self):
     return "ProtectedField({}, {})".format(self.obj.node if hasattr(self.obj, "node") else self.obj, self.name)
 
+class FieldGraph:
+  DIRTY = 1
+  RELEASED = 2
+  PURGE_SIZE = 64
+
+  def __init__(self):
+    self.flags = bytearray()
+    self.edges = []
+    self.edge_ids = set()
+    self.sources = {}
+
+  def add_edges(self, sources, target):
+    edges = self.edges
+    field_type = GraphField
+    for source in sources:
+      if type(source) is not field_type:
+        source.invalidations.add(target)
+        self.sources.setdefault(target.id, []).append(source)
+        continue
+      targets = edges[source.id]
+      if targets is None:
+        edges[source.id] = [target]
+      else:
+        targets.append(target)
+        size = len(targets)
+        if not size & (size - 1) and size >= self.PURGE_SIZE:
+          self.purge(source.id)
+
+  def add_edge(self, source, target):
+    key = source.id << 32 | target.id
+    if key in self.edge_ids: return
+    self.edge_ids.add(key)
+    self.add_edges((source,), target)
+
+  def purge(self, id):
+    flags = self.flags
+    live = []
+    for target in dict.fromkeys(self.edges[id]):
+      if flags[target.id] != self.RELEASED:
+        live.append(target)
+      elif not target.frozen_dependencies:
+        self.edge_ids.discard(id << 32 | target.id)
+    self.edges[id] = live
+
+  def notify(self, id, parent):
+    targets = self.edges[id]
+    if targets:
+      flags = self.flags
+      for field in targets:
+        if flags[field.id]: continue
+        flags[field.id] = self.DIRTY
+        ancestor = field.parent
+        while ancestor and not ancestor.has_dirty_descendants:
+          ancestor.has_dirty_descendants = True
+          ancestor = ancestor.parent
+    while parent and not parent.has_dirty_descendants:
+      parent.has_dirty_descendants = True
+      parent = parent.parent
+
+  def release(self, layout_objects):
+    edges = self.edges
+    edge_ids = self.edge_ids
+    for obj in layout_objects:
+      for field in vars(obj).values():
+        if type(field) is not GraphField: continue
+        id = field.id
+        targets = edges[id]
+        if targets:
+          for target in targets:
+            if not target.frozen_dependencies:
+              edge_ids.discard(id << 32 | target.id)
+          edges[id] = None
+        if id in self.sources:
+          for source in self.sources.pop(id):
+            source.invalidations.discard(field)
+        self.flags[id] = self.RELEASED
+
+  def __repr__(self):
+    return "FieldGraph(fields={}, edges={})".format(
+      len(self.flags), len(self.edge_ids))
+
+class GraphField:
+  __slots__ = ("graph", "id", "obj", "name", "parent", "value", "frozen_dependencies")
+
+  def __init__(self, graph, obj, name, parent=None, dependencies=None):
+    self.graph = graph
+    self.id = len(graph.edges)
+    graph.edges.append(None)
+    graph.flags.append(FieldGraph.DIRTY)
+    self.obj = obj
+    self.name = name
+    self.parent = parent
+    self.value = None
+    self.frozen_dependencies = dependencies != None
+    if dependencies:
+      graph.add_edges(dependencies, self)
+
+  @property
+  def dirty(self):
+    return self.graph.flags[self.id] == FieldGraph.DIRTY
+
+  def mark(self):
+    flags = self.graph.flags
+    if flags[self.id]: return
+    flags[self.id] = FieldGraph.DIRTY
+    parent = self.parent
+    while parent and not parent.has_dirty_descendants:
+      parent.has_dirty_descendants = True
+      parent = parent.parent
+
+  def get(self):
+    assert self.graph.flags[self.id] != FieldGraph.DIRTY
+    return self.value
+
+  def read(self, notify):
+    graph = self.graph
+    if not notify.frozen_dependencies:
+      graph.add_edge(self, notify)
+    assert graph.flags[self.id] != FieldGraph.DIRTY
+    return self.value
+
+  def set(self, value):
+    if value != self.value:
+      self.graph.notify(self.id, self.parent)
+    self.value = value
+    flags = self.graph.flags
+    if flags[self.id] == FieldGraph.DIRTY:
+      flags[self.id] = 0
+
+  def notify(self):
+    self.graph.notify(self.id, self.parent)
+
+  def copy(self, field):
+    graph = self.graph
+    if not self.frozen_dependencies:
+      graph.add_edge(field, self)
+    assert graph.flags[field.id] != FieldGraph.DIRTY
+    value = field.value
+    if value != self.value:
+      graph.notify(self.id, self.parent)
+    self.value = value
+    if graph.flags[self.id] == FieldGraph.DIRTY:
+      graph.flags[self.id] = 0
+
+  def set_ancestor_dirty_flags(self):
+    parent = self.parent
+    while parent and not parent.has_dirty_descendants:
+      parent.has_dirty_descendants = True
+      parent = parent.parent
+
+  def set_dependencies(self, dependencies):
+    self.graph.add_edges(dependencies, self)
+    self.frozen_dependencies = True
+
+  def __repr__(self):
+    return "GraphField({}, {})".format(self.obj.node if hasattr(self.obj, "node") else self.obj, self.name)
+
+def make_field(obj, name, parent=None, dependencies=None):
+  if obj.document.graph is None:
+    return ProtectedField(obj, name, parent, dependencies)
+  return GraphField(obj.document.graph, obj, name, parent, dependencies)
+
+def tree_position(layout_object):
+  position = []
+  while layout_object.parent:
+    children = layout_object.parent.children
+    if not isinstance(children, list):
+      children = children.get()
+    position.append(children.index(layout_object))
+    layout_object = layout_object.parent
+  position.reverse()
+  return position
+
+def subtree_objects(layout_objects):
+  objects = []
+  stack = list(layout_objects)
+  while stack:
+    obj = stack.pop()
+    objects.append(obj)
+    children = obj.children
+    if not isinstance(children, list):
+      children = children.value or []
+    stack.extend(children)
+  return objects
+
 class DocumentLayout:
   def __init__(self, node, frame):
     self.node = node
     self.frame = frame
+    self.document = self
+    self.graph = FieldGraph() if LAYOUT_FIELD_GRAPH else None
     node.layout_object = self
     self.parent = None
     self.previous = None
     self.children = []
-
-    self.zoom = ProtectedField(self, "zoom", None, [])
-    self.width = ProtectedField(self, "width", None, [])
-    self.x = ProtectedField(self, "x", None, [])
-    self.y = ProtectedField(self, "y", None, [])
-    self.height = ProtectedField(self, "height")
+    self.viewport = None
+    self.checked_viewport = None
+    self.estimated_blocks = set()
+    self.fragments = {}
+    self.relaid_out = {}
+    self.painted_scroll = 0
+    self.add_fragment(self)
+
+    self.zoom = make_field(self, "zoom", None, [])
+    self.width = make_field(self, "width", None, [])
+    self.x = make_field(self, "x", None, [])
+    self.y = make_field(self, "y", None, [])
+    self.height = make_field(self, "height")
 
     self.has_dirty_descendants = True
+    self.paint_dirty = True
+    self.paint_cache = None
 
   def layout_needed(self):
     if self.zoom.dirty: return True
@@ -137,6 +462,8 @@ class DocumentLayout:
 
   def layout(self, width, zoom):
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
 
     self.zoom.set(zoom)
     self.width.set(width - 2*dpx(HSTEP, zoom))
@@ -154,6 +481,58 @@ class DocumentLayout:
     child.layout()
     self.has_dirty_descendants = False 
     self.height.copy(child.height)
+
+  def set_viewport(self, scroll, height):
+    self.viewport = (scroll - height, scroll + 2 * height)
+
+  def realize_visible(self):
+    if self.checked_viewport == self.viewport: return []
+    self.checked_viewport = self.viewport
+    top, bottom = self.viewport
+    realized = []
+    for block in self.estimated_blocks:
+      y = block.y.get()
+      height = block.height.get()
+      if y < bottom and y + height > top:
+        realized.append((block, y, height))
+    for block, y, height in realized:
+      block.children.mark()
+    return realized
+
+  def realize_node(self, node):
+    realized = False
+    while node:
+      block = node.layout_object
+      if block in self.estimated_blocks:
+        block.lazy = False
+        block.children.mark()
+        realized = True
+      node = node.parent
+    return realized
+
+  def add_fragment(self, obj):
+    self.fragments.setdefault(obj.node, {})[obj] = None
+
+  def fragments_for(self, node):
+    return list(self.fragments.get(node, ()))
+
+  def invalidate_paint(self, node):
+    for painted in [node] + node.children:
+      for obj in self.fragments.get(painted, ()):
+        invalidate_paint(obj)
+
+  def remove_fragments(self, layout_objects):
+    objects = subtree_objects(layout_objects)
+    for obj in objects:
+      fragments = self.fragments.get(obj.node)
+      if fragments and obj in fragments:
+        del fragments[obj]
+        if not fragments:
+          del self.fragments[obj.node]
+      self.estimated_blocks.discard(obj)
+      self.relaid_out[obj] = False
+    if self.graph:
+      self.graph.release(objects)
   
   def paint(self):
     return []
@@ -168,6 +547,7 @@ class DocumentLayout:
         self.x.get() + self.width.get(), self.y.get() + self.height.get()
       )
       cmds = [Transform((0, -self.frame.scroll), rect, self.node, cmds)]
+    self.painted_scroll = self.frame.scroll
     return cmds
 
 class BlockLayout:
@@ -176,20 +556,28 @@ class BlockLayout:
     node.layout_object = self
     self.frame = frame
     self.parent = parent
+    self.document = parent.document
+    self.document.add_fragment(self)
     self.previous = previous
+    self.lazy = True
+    self.laid_out = False
 
-    self.zoom = ProtectedField(self, "zoom", self.parent, [self.parent.zoom])
-    self.width = ProtectedField(self, "width", self.parent, [self.parent.width])
-    self.height = ProtectedField(self, "height", self.parent)
-    self.x = ProtectedField(self, "x", self.parent, [self.parent.x])
+    self.zoom = make_field(self, "zoom", self.parent, [self.parent.zoom])
+    self.width = make_field(self, "width", self.parent, [self.parent.width])
+    self.height = make_field(self, "height", self.parent)
+    self.x = make_field(self, "x", self.parent, [self.parent.x])
     if self.previous:
       y_dependencies = [self.previous.y, self.previous.height]
     else:
       y_dependencies = [self.parent.y]
-    self.y = ProtectedField(self, "y", self.parent, y_dependencies)
-    self.children = ProtectedField(self, "children", self.parent, None)
+    self.y = make_field(self, "y", self.parent, y_dependencies)
+    self.children = make_field(self, "children", self.parent, None)
+    self.inline_items = None
+    self.line_metrics = None
 
     self.has_dirty_descendants = True
+    self.paint_dirty = True
+    self.paint_cache = None
 
   def layout_needed(self):
     if self.zoom.dirty: return True
@@ -203,6 +591,8 @@ class BlockLayout:
 
   def layout(self):
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
 
     self.zoom.copy(self.parent.zoom)
     self.width.copy(self.parent.width)
@@ -214,9 +604,21 @@ class BlockLayout:
     else:
       self.y.copy(self.parent.y)
 
+    if not self.laid_out:
+      if self.lazy and self.below_viewport():
+        self.estimate_height()
+        return
+      self.document.estimated_blocks.discard(self)
+      self.children.mark()
+      self.laid_out = True
+
     mode = self.layout_mode()
     if mode == "block":
       if self.children.dirty:
+        if self.children.value:
+          self.document.remove_fragments(self.children.value)
+        self.inline_items = None
+        self.line_metrics = None
         children = []
         previous = None
         for child in self.node.children:
@@ -230,15 +632,16 @@ class BlockLayout:
         self.height.set_dependencies(height_dependencies)
     else:
       if self.children.dirty:
-        self.temp_children = []
-        self.new_line()
+        self.temp_items = []
         self.recurse(self.node)
+        self.break_lines(self.temp_items)
         self.children.set(self.temp_children)
 
         height_dependencies = [child.height for child in self.temp_children]
         height_dependencies.append(self.children)
         self.height.set_dependencies(height_dependencies)
         self.temp_children = None
+        self.temp_items = None
     
     for child in self.children.get():
       child.layout()
@@ -252,6 +655,34 @@ class BlockLayout:
     ])
     self.height.set(new_height)
 
+  def below_viewport(self):
+    viewport = self.document.viewport
+    return viewport is not None and self.y.get() > viewport[1]
+
+  def estimate_height(self):
+    zoom = self.zoom.get()
+    width = self.width.get()
+    node_font = font(self.node.style, zoom, notify=self.children)
+    chars = 0
+    paragraphs = 0
+    embeds = 0
+    for node in tree_to_list(self.node, []):
+      if isinstance(node, Text):
+        chars += len(node.text) + 1
+      elif node.tag in ["input", "button", "img", "iframe"]:
+        embeds += 1
+      elif node.tag in BLOCK_ELEMENTS and \
+        any([isinstance(child, Text) for child in node.children]):
+        paragraphs += 1
+    lines = embeds
+    if width > 0:
+      lines += max(math.ceil(chars * measure_text(node_font, "n") / width), paragraphs)
+    self.children.set([])
+    self.height.set(lines * node_font.linespace * 1.25)
+    self.document.estimated_blocks.add(self)
+    self.document.checked_viewport = None
+    self.has_dirty_descendants = False
+
   def layout_mode(self):
     if isinstance(self.node, Text):
       return "inline"
@@ -272,7 +703,7 @@ class BlockLayout:
         self.word(node, word)
     else:
       if node.tag == "br":
-        self.new_line()
+        self.temp_items.append((node, "br", None, 0))
       elif node.tag == "input" or node.tag == "button":
         self.input(node)
       elif node.tag == "img":
@@ -288,13 +719,13 @@ class BlockLayout:
   def word(self, node, word):
     zoom = self.zoom.read(notify=self.children)
     node_font = font(node.style, zoom, notify=self.children)
-    w = node_font.measureText(word)
-    self.add_inline_child(node, w, TextLayout, self.frame, word)
+    w = measure_text(node_font, word)
+    self.temp_items.append((node, "word", word, w))
    
   def input(self, node):
     zoom = self.zoom.read(notify=self.children)
     w = dpx(INPUT_WIDTH_PX, zoom)
-    self.add_inline_child(node, w, InputLayout, self.frame)
+    self.temp_items.append((node, "embed", InputLayout, w))
  
   def image(self, node):
     zoom = self.zoom.read(notify=self.children)
@@ -302,7 +733,7 @@ class BlockLayout:
       w = dpx(int(node.attributes["width"]), zoom)
     else:
       w = dpx(node.image.width(), zoom)
-    self.add_inline_child(node, w, ImageLayout, self.frame)
+    self.temp_items.append((node, "embed", ImageLayout, w))
   
   def iframe(self, node):
     zoom = self.zoom.read(notify=self.children)
@@ -310,13 +741,86 @@ class BlockLayout:
       w = dpx(int(node.attributes["width"]), zoom)
     else:
       w = IFRAME_WIDTH_PX + dpx(2, zoom)
-    self.add_inline_child(node, w, IframeLayout, self.frame)
+    self.temp_items.append((node, "embed", IframeLayout, w))
   
+  def break_lines(self, items):
+    zoom = self.zoom.read(notify=self.children)
+    width = self.width.read(notify=self.children)
+    old_lines = self.children.value or []
+    self.temp_children = []
+    start = 0
+    opener = None
+    delta = 0
+    tail = {}
+    if old_lines and self.line_metrics == (zoom, width):
+      old_items = self.inline_items
+      if old_items == items:
+        self.temp_children = list(old_lines)
+        return
+      delta = len(items) - len(old_items)
+      size = min(len(old_items), len(items))
+      changed = 0
+      while changed < size and old_items[changed] == items[changed]:
+        changed += 1
+      same_suffix = 0
+      while same_suffix < size - changed and \
+        old_items[-1 - same_suffix] == items[-1 - same_suffix]:
+        same_suffix += 1
+      reused = 0
+      while reused + 1 < len(old_lines) and old_lines[reused + 1].start < changed:
+        reused += 1
+      while reused and old_lines[reused].opened_by == "wrap" and \
+        items[old_lines[reused].start][3] > width:
+        reused -= 1
+      self.temp_children = old_lines[:reused]
+      start = old_lines[reused].start
+      opener = old_lines[reused].opened_by
+      old_lines = old_lines[reused:]
+      for index, line in enumerate(old_lines):
+        if index and line.start >= len(old_items) - same_suffix:
+          tail.setdefault((line.start + delta, line.opened_by), index)
+    self.inline_items = items
+    self.line_metrics = (zoom, width)
+
+    self.item_index = start
+    self.line_opener = opener
+    self.new_line()
+    realigned = len(old_lines)
+    for index in range(start, len(items)):
+      node, kind, value, w = items[index]
+      if kind == "br":
+        if (index + 1, "br") in tail:
+          realigned = tail[(index + 1, "br")]
+          break
+        self.item_index = index + 1
+        self.line_opener = "br"
+        self.new_line()
+        continue
+      if (index, "wrap") in tail and self.cursor_x + w > width:
+        realigned = tail[(index, "wrap")]
+        break
+      self.item_index = index
+      self.line_opener = "wrap"
+      if kind == "word":
+        self.add_inline_child(node, w, TextLayout, self.frame, value)
+      else:
+        self.add_inline_child(node, w, value, self.frame)
+
+    if old_lines[:realigned]:
+      self.document.remove_fragments(old_lines[:realigned])
+    if realigned < len(old_lines):
+      old_lines[realigned].set_previous(self.temp_children[-1])
+      for line in old_lines[realigned:]:
+        line.start += delta
+      self.temp_children.extend(old_lines[realigned:])
+
   def new_line(self):
     self.previous_word = None
     self.cursor_x = 0
     last_line = self.temp_children[-1] if self.temp_children else None
     new_line = LineLayout(self.node, self, last_line)
+    new_line.start = self.item_index
+    new_line.opened_by = self.line_opener
     self.temp_children.append(new_line)
   
   def self_rect(self):
@@ -324,11 +828,11 @@ class BlockLayout:
 
   def paint(self):
     cmds = []
-    bgcolor = self.node.style["background-color"].get()
+    bgcolor = self.node.style["background-color"].get_computed()
 
-    if bgcolor != "transparent":
-      radius = dpx(float(
-        self.node.style["border-radius"].get()[:-2]),
+    if bgcolor is not None:
+      radius = dpx(
+        self.node.style["border-radius"].get_computed(),
         self.zoom.get()
       )
       cmds.append(DrawRRect(
@@ -339,14 +843,23 @@ class BlockLayout:
   def should_paint(self):
     return isinstance(self.node, Text) or (self.node.tag not in ["input", "button", "img", "iframe"])
   
+  def last_text_fragment(self):
+    for child in reversed(self.children.value or []):
+      if isinstance(child, LineLayout):
+        for fragment in reversed(child.children):
+          if isinstance(fragment, TextLayout):
+            return fragment
+      else:
+        fragment = child.last_text_fragment()
+        if fragment:
+          return fragment
+    return None
+
   def paint_effects(self, cmds):
     if self.node.is_focused and "contenteditable" in self.node.attributes:
-      text_nodes = [
-        t for t in tree_to_list(self, [])
-        if isinstance(t, TextLayout)
-      ]
-      if text_nodes:
-        cmds.append(DrawCursor(text_nodes[-1], text_nodes[-1].width.get()))
+      text = self.last_text_fragment()
+      if text:
+        cmds.append(DrawCursor(text, text.width.get()))
       else:
         cmds.append(DrawCursor(self, 0))
 
@@ -360,37 +873,51 @@ class BlockLayout:
     if self.cursor_x + w > width:
       self.new_line()
     line = self.temp_children[-1]
-    if word:
-      child = child_class(node, word, line, self.previous_word)
+    previous = self.previous_word
+    if word and TEXT_RUN_LAYOUT and isinstance(previous, TextLayout) \
+      and previous.node is node and previous.parent is line:
+      previous.add_word(word)
+      child = previous
+    elif word:
+      child = child_class(node, word, line, previous)
     else:
       child = child_class(node, line, self.previous_word, frame)
-    line.children.append(child)
+    if child is not previous:
+      line.children.append(child)
     self.previous_word = child
     zoom = self.zoom.read(notify=self.children)
-    self.cursor_x += w + font(node.style, zoom, notify=self.children).measureText(" ")
+    self.cursor_x += w + font(node.style, zoom, notify=self.children).space_width
 
 class LineLayout:
   def __init__(self, node, parent, previous):
     self.node = node
     self.parent = parent
+    self.document = parent.document
     self.previous = previous
     self.children = []
 
-    self.zoom = ProtectedField(self, "zoom", self.parent, [self.parent.zoom])
-    self.x = ProtectedField(self, "x", self.parent, [self.parent.x])
+    self.zoom = make_field(self, "zoom", self.parent, [self.parent.zoom])
+    self.x = make_field(self, "x", self.parent, [self.parent.x])
     if self.previous:
       y_dependencies = [self.previous.y, self.previous.height]
     else:
       y_dependencies = [self.parent.y]
-    self.y = ProtectedField(self, "y", self.parent, y_dependencies)
+    self.y = make_field(self, "y", self.parent, y_dependencies)
     self.initialized_fields = False
-    self.ascent = ProtectedField(self, "ascent", self.parent)
-    self.descent = ProtectedField(self, "descent", self.parent)
+    self.ascent = make_field(self, "ascent", self.parent)
+    self.descent = make_field(self, "descent", self.parent)
 
-    self.width = ProtectedField(self, "width", self.parent, [self.parent.width])
-    self.height = ProtectedField(self, "height", self.parent, [self.ascent, self.descent])
+    self.width = make_field(self, "width", self.parent, [self.parent.width])
+    self.height = make_field(self, "height", self.parent, [self.ascent, self.descent])
 
     self.has_dirty_descendants = True
+    self.paint_dirty = True
+    self.paint_cache = None
+
+  def set_previous(self, previous):
+    self.previous = previous
+    self.y.set_dependencies([previous.y, previous.height])
+    self.y.mark()
 
   def layout_needed(self):
     if self.zoom.dirty: return True
@@ -414,6 +941,8 @@ class LineLayout:
       self.initialized_fields = True
 
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
 
     self.zoom.copy(self.parent.zoom)
     self.width.copy(self.parent.width)
@@ -451,6 +980,8 @@ class LineLayout:
           new_y += child.ascent.read(notify=child.y) / 1.25
       else:
           new_y += child.ascent.read(notify=child.y)
+      if new_y != child.y.value:
+        invalidate_paint(child)
       child.y.set(new_y)
     
     max_ascent = self.ascent.read(notify=self.height)
@@ -477,7 +1008,7 @@ class LineLayout:
     outline_rect = skia.Rect.MakeEmpty()
     outline_node = None
     for child in self.children:
-      child_outline = parse_outline(child.node.parent.style["outline"].get())
+      child_outline = child.node.parent.style["outline"].get_computed()
       if child_outline:
         outline_rect.join(child.self_rect())
         outline_node = child.node.parent
@@ -489,28 +1020,37 @@ class TextLayout:
   def __init__(self, node, word, parent, previous):
     self.node = node
     self.parent = parent
+    self.document = parent.document
+    self.document.add_fragment(self)
     self.previous = previous
     self.children = []
+    self.words = [word]
     self.word = word
 
-    self.zoom = ProtectedField(self, "zoom", self.parent, [self.parent.zoom])
-    self.font = ProtectedField(self, "font", self.parent,
+    self.zoom = make_field(self, "zoom", self.parent, [self.parent.zoom])
+    self.font = make_field(self, "font", self.parent,
       [self.zoom,
        self.node.style["font-weight"],
        self.node.style["font-style"],
        self.node.style["font-size"]])
-    self.width = ProtectedField(self, "width", self.parent, [self.font])
-    self.height = ProtectedField(self, "height", self.parent, [self.font])
-    self.ascent = ProtectedField(self, "ascent", self.parent, [self.font])
-    self.descent = ProtectedField(self, "descent", self.parent, [self.font])
+    self.width = make_field(self, "width", self.parent, [self.font])
+    self.height = make_field(self, "height", self.parent, [self.font])
+    self.ascent = make_field(self, "ascent", self.parent, [self.font])
+    self.descent = make_field(self, "descent", self.parent, [self.font])
     if self.previous:
       x_dependencies = [self.previous.x, self.previous.font, self.previous.width]
     else:
       x_dependencies = [self.parent.x]
-    self.x = ProtectedField(self, "x", self.parent, x_dependencies)
-    self.y = ProtectedField(self, "y", self.parent, [self.ascent, self.parent.y, self.parent.ascent])
+    self.x = make_field(self, "x", self.parent, x_dependencies)
+    self.y = make_field(self, "y", self.parent, [self.ascent, self.parent.y, self.parent.ascent])
 
     self.has_dirty_descendants = True
+    self.paint_dirty = True
+    self.paint_cache = None
+
+  def add_word(self, word):
+    self.words.append(word)
+    self.word += " " + word
 
   def layout_needed(self):
     if self.zoom.dirty: return True
@@ -526,6 +1066,8 @@ class TextLayout:
 
   def layout(self):
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
 
     self.zoom.copy(self.parent.zoom)
 
@@ -533,22 +1075,23 @@ class TextLayout:
     self.font.set(font(self.node.style, zoom, notify=self.font))
 
     f = self.font.read(notify=self.width)
-    self.width.set(f.measureText(self.word))
+    self.width.set(sum([measure_text(f, word) for word in self.words])
+      + f.space_width * (len(self.words) - 1))
 
     f = self.font.read(notify=self.ascent)
-    self.ascent.set(f.getMetrics().fAscent * 1.25)
+    self.ascent.set(f.ascent * 1.25)
 
     f = self.font.read(notify=self.descent)
-    self.descent.set(f.getMetrics().fDescent * 1.25)
+    self.descent.set(f.descent * 1.25)
 
     f = self.font.read(notify=self.height)
-    self.height.set(linespace(f) * 1.25)
+    self.height.set(f.linespace * 1.25)
 
     if self.previous:
       prev_x = self.previous.x.read(notify=self.x)
       prev_font = self.previous.font.read(notify=self.x)
       prev_width = self.previous.width.read(notify=self.x)
-      self.x.set(prev_x + prev_font.measureText(' ') + prev_width)
+      self.x.set(prev_x + prev_font.space_width + prev_width)
     else:
       self.x.copy(self.parent.x)
 
@@ -557,7 +1100,7 @@ class TextLayout:
   def paint(self):
     cmds = []
     leading = self.height.get() / 1.25 * .25 / 2
-    color = self.node.style["color"].get()
+    color = self.node.style["color"].get_computed()
     cmds.append(DrawText(self.x.get(), self.y.get() + leading, self.word, self.font.get(), color))
     return cmds
   
@@ -581,28 +1124,32 @@ class EmbedLayout:
     self.frame = frame
     node.layout_object = self
     self.parent = parent
+    self.document = parent.document
+    self.document.add_fragment(self)
     self.previous = previous
 
     self.children = []
-    self.zoom = ProtectedField(self, "zoom", self.parent, [self.parent.zoom])
-    self.font = ProtectedField(self, "font", self.parent,
+    self.zoom = make_field(self, "zoom", self.parent, [self.parent.zoom])
+    self.font = make_field(self, "font", self.parent,
       [self.zoom,
       self.node.style['font-weight'],
       self.node.style['font-style'],
       self.node.style['font-size']])
-    self.width = ProtectedField(self, "width", self.parent, [self.zoom])
-    self.height = ProtectedField(self, "height", self.parent, [self.zoom, self.font, self.width])
-    self.ascent = ProtectedField(self, "ascent", self.parent, [self.height])
-    self.descent = ProtectedField(self, "descent", self.parent, [])
+    self.width = make_field(self, "width", self.parent, [self.zoom])
+    self.height = make_field(self, "height", self.parent, [self.zoom, self.font, self.width])
+    self.ascent = make_field(self, "ascent", self.parent, [self.height])
+    self.descent = make_field(self, "descent", self.parent, [])
 
     if self.previous:
       x_dependencies = [self.previous.x, self.previous.font, self.previous.width]
     else:
       x_dependencies = [self.parent.x]
-    self.x = ProtectedField(self, "x", self.parent, x_dependencies)
-    self.y = ProtectedField(self, "y", self.parent, [self.ascent, self.parent.y, self.parent.ascent])
+    self.x = make_field(self, "x", self.parent, x_dependencies)
+    self.y = make_field(self, "y", self.parent, [self.ascent, self.parent.y, self.parent.ascent])
   
     self.has_dirty_descendants = True
+    self.paint_dirty = True
+    self.paint_cache = None
   
   def layout_needed(self):
     if self.zoom.dirty: return True
@@ -626,7 +1173,7 @@ class EmbedLayout:
       prev_x = self.previous.x.read(notify=self.x)
       prev_font = self.previous.font.read(notify=self.x)
       prev_width = self.previous.width.read(notify=self.x)
-      self.x.set(prev_x + prev_font.measureText(' ') + prev_width)
+      self.x.set(prev_x + prev_font.space_width + prev_width)
     else:
       self.x.copy(self.parent.x)
 
@@ -641,12 +1188,14 @@ class InputLayout(EmbedLayout):
 
   def layout(self):
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
     super().layout()
     zoom = self.zoom.read(notify=self.width)
     self.width.set(dpx(INPUT_WIDTH_PX, zoom))
 
     font = self.font.read(notify=self.height)
-    self.height.set(linespace(font))
+    self.height.set(font.linespace)
 
     height = self.height.read(notify=self.ascent)
     self.ascent.set(-height)
@@ -658,10 +1207,10 @@ class InputLayout(EmbedLayout):
   def paint(self):
     cmds = []
 
-    bgcolor = self.node.style["background-color"].get()
-    if bgcolor != "transparent":
-      radius = dpx(float(
-        self.node.style["border-radius"].get()[:-2]), self.zoom.get())
+    bgcolor = self.node.style["background-color"].get_computed()
+    if bgcolor is not None:
+      radius = dpx(
+        self.node.style["border-radius"].get_computed(), self.zoom.get())
       cmds.append(DrawRRect(self.self_rect(), radius, bgcolor))
 
     if self.node.tag == "input":
@@ -672,13 +1221,13 @@ class InputLayout(EmbedLayout):
       else:
         print("HTML inside button not implemented yet")
         text = ""
-    color = self.node.style["color"].get()
+    color = self.node.style["color"].get_computed()
     cmds.append(
       DrawText(self.x.get(), self.y.get(), text, self.font.get(), color)
     )
 
     if self.node.is_focused and self.node.tag == "input":
-      cmds.append(DrawCursor(self, self.font.get().measureText(text)))
+      cmds.append(DrawCursor(self, measure_text(self.font.get(), text)))
 
     return cmds
   
@@ -693,6 +1242,8 @@ class ImageLayout(EmbedLayout):
 
   def layout(self):
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
     super().layout()
     width_attr = self.node.attributes.get("width")
     height_attr = self.node.attributes.get("height")
@@ -717,7 +1268,7 @@ class ImageLayout(EmbedLayout):
       self.img_height = dpx(image_height, h_zoom)
 
     font = self.font.read(notify=self.height)
-    self.height.set(max(self.img_height, linespace(font)))
+    self.height.set(max(self.img_height, font.linespace))
 
     height = self.height.read(notify=self.ascent)
     self.ascent.set(-height)
@@ -742,6 +1293,8 @@ class IframeLayout(EmbedLayout):
   
   def layout(self):
     if not self.layout_needed(): return
+    invalidate_paint(self)
+    self.document.relaid_out[self] = True
     super().layout()
 
     width_attr = self.node.attributes.get("width")
@@ -774,10 +1327,10 @@ class IframeLayout(EmbedLayout):
       self.x.get(), self.y.get(),
       self.x.get() + self.width.get(), self.y.get() + self.height.get()
     )
-    bgcolor = self.node.style["background-color"].get()
-    if bgcolor != "transparent":
-      radius = dpx(float(
-        self.node.style["border-radius"].get()[:-2]), self.zoom.get()
+    bgcolor = self.node.style["background-color"].get_computed()
+    if bgcolor is not None:
+      radius = dpx(
+        self.node.style["border-radius"].get_computed(), self.zoom.get()
       )
       cmds.append(DrawRRect(rect, radius, bgcolor))
     return cmds
@@ -793,7 +1346,7 @@ class IframeLayout(EmbedLayout):
       self.y.get() + self.height.get() - diff
     )
     internal_cmds = cmds
-    internal_cmds.append(Blend(1.0, "destination-in", None, [DrawRRect(inner_rect, 0, "white")]))
+    internal_cmds.append(Blend(1.0, "destination-in", None, [DrawRRect(inner_rect, 0, skia.ColorWHITE)]))
     cmds = [Blend(1.0, "source-over", self.node, internal_cmds)]
     paint_outline(self.node, cmds, rect, self.zoom.get())
     cmds = paint_visual_effects(self.node, cmds, inner_rect)
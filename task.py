@@ -1,3 +1,4 @@
+import json
 import threading
 import time
 
@@ -107,6 +108,19 @@ class MeasureTime:
     )
     self.lock.release()
 
+  def counter(self, name, values):
+    self.lock.acquire(blocking=True)
+    ts = time.time() * 1000000
+    tid = threading.get_ident()
+    self.file.write(
+      ', { "ph": "C", "cat": "_",' +
+      '"name": "' + name + '",' +
+      '"ts": ' + str(ts) + ',' +
+      '"pid": 1, "tid": ' + str(tid) + ',' +
+      '"args": ' + json.dumps(values) + '}'
+    )
+    self.lock.release()
+
   def finish(self):
     self.lock.acquire(blocking=True)
     ts = time.time() * 1000000
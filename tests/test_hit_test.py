@@ -0,0 +1,39 @@
+import skia
+from css import absolute_bounds_for_obj
+from dom import tree_to_list
+from test_raster_equivalence import Session
+
+def brute_force_hit_test(frame, x, y):
+  point = skia.Rect.MakeXYWH(x, y, 1, 1)
+  hits = [obj for obj in tree_to_list(frame.document, [])
+    if absolute_bounds_for_obj(obj).intersects(point)]
+  return hits[-1] if hits else None
+
+def check_hits(s):
+  s.tab.render()
+  frame = s.tab.root_frame
+  height = frame.document.height.get()
+  for x in range(0, 800, 61):
+    for y in range(0, int(height), 29):
+      assert frame.hit_test(x, y) is brute_force_hit_test(frame, x, y), (x, y)
+
+def test_incremental_hit_index():
+  s = Session("<input>" + "".join(
+    "<p>paragraph {} with <b>bold</b> words</p>".format(i) for i in range(30)
+  ) + "<div style=transform:translate(20px,10px)><p>moved</p></div>", True)
+  s.frame()
+  index = s.tab.root_frame.hit_test_index()
+  for step in [
+    lambda: None,
+    lambda: s.js("document.querySelectorAll('b')[3]"
+      ".innerHTML = 'much longer bold text that wraps onto another line'"),
+    lambda: s.js("document.querySelectorAll('div')[0]"
+      ".style = 'transform:translate(80px,40px)'"),
+    lambda: s.js("document.querySelectorAll('p')[2].innerHTML = ''"),
+    lambda: s.tab.root_frame.focus_element(s.element("input")),
+    lambda: s.tab.keypress("a"),
+    lambda: s.tab.zoom_by(1),
+  ]:
+    step()
+    check_hits(s)
+    assert s.tab.root_frame.hit_index is index
@@ -0,0 +1,226 @@
+import math
+import threading
+import skia
+import browser_ui
+import draw
+import layout
+from browser_ui import Browser, Chrome, Tab
+from constants import WIDTH, HEIGHT
+from dom import tree_to_list
+from network import URL
+
+# Drives two browsers through the same steps: one with every incremental
+# path enabled, one that repaints, recomposites and redraws each frame
+# from scratch. Their pixels must match after every step.
+
+class NoMeasure:
+  def time(self, name): pass
+  def stop(self, name): pass
+  def counter(self, name, value): pass
+  def finish(self): pass
+
+def make_browser():
+  browser = object.__new__(Browser)
+  browser.width = WIDTH
+  browser.height = HEIGHT
+  browser.chrome = Chrome(browser)
+  browser.sdl_window = None
+  browser.skia_context = None
+  browser.root_surface = skia.Surface(WIDTH, HEIGHT)
+  browser.chrome_surface = skia.Surface(WIDTH, math.ceil(browser.chrome.bottom))
+  browser.tabs = []
+  browser.active_tab = None
+  browser.focus = None
+  browser.address_bar = ""
+  browser.lock = threading.Lock()
+  browser.active_tab_url = None
+  browser.active_tab_scroll = 0
+  browser.measure = NoMeasure()
+  browser.animation_timer = None
+  browser.needs_animation_frame = False
+  browser.needs_composite = False
+  browser.needs_raster = False
+  browser.needs_draw = False
+  browser.needs_accessibility = False
+  browser.active_tab_height = 0
+  browser.active_tab_display_list = None
+  browser.composited_updates = {}
+  browser.composited_layers = []
+  browser.draw_list = []
+  browser.dark_mode = False
+  browser.frame_surface = None
+  browser.drawn_state = None
+  browser.drawn_scroll = 0
+  browser.damage = skia.Region()
+  browser.tab_damage = skia.Region()
+  browser.accessibility_is_on = False
+  browser.has_spoken_document = False
+  browser.needs_speak_hovered_node = False
+  browser.tab_focus = None
+  browser.last_tab_focus = None
+  browser.pending_hover = None
+  browser.hovered_a11y_node = None
+  browser.focus_a11y_node = None
+  browser.active_alerts = []
+  browser.spoken_alerts = []
+  browser.root_frame_focused = False
+  return browser
+
+class Session:
+  def __init__(self, html, incremental):
+    self.incremental = incremental
+    self.browser = make_browser()
+    self.tab = Tab(self.browser, HEIGHT - self.browser.chrome.bottom)
+    self.tab.task_runner.set_needs_quit()
+    self.browser.tabs.append(self.tab)
+    self.browser.active_tab = self.tab
+    self.tab.load(URL("data:text/html," + html))
+
+  def element(self, tag):
+    for node in tree_to_list(self.tab.root_frame.nodes, []):
+      if getattr(node, "tag", None) == tag:
+        return node
+
+  def js(self, code):
+    frame = self.tab.root_frame
+    frame.js.run("test", code, frame.window_id)
+
+  def frame(self):
+    paint_cache = layout.PAINT_CACHE
+    partial_redraw = browser_ui.PARTIAL_REDRAW
+    swap = browser_ui.sdl2.SDL_GL_SwapWindow
+    browser_ui.sdl2.SDL_GL_SwapWindow = lambda window: None
+    if not self.incremental:
+      layout.PAINT_CACHE = False
+      browser_ui.PARTIAL_REDRAW = False
+      self.tab.set_needs_paint()
+    try:
+      self.tab.run_animation_frame(self.browser.active_tab_scroll)
+      if not self.incremental:
+        self.browser.composited_layers = []
+        self.browser.composited_updates = {}
+        self.browser.set_needs_composite()
+      self.browser.composite_raster_and_draw()
+    finally:
+      layout.PAINT_CACHE = paint_cache
+      browser_ui.PARTIAL_REDRAW = partial_redraw
+      browser_ui.sdl2.SDL_GL_SwapWindow = swap
+    return self.browser.root_surface.makeImageSnapshot().tobytes()
+
+def check_frames(html, steps):
+  sessions = [Session(html, True), Session(html, False)]
+  for i, step in enumerate([None] + steps):
+    pixels = []
+    for session in sessions:
+      if step: step(session)
+      pixels.append(session.frame())
+    assert pixels[0] == pixels[1], "frame {} differs".format(i)
+
+def test_paint_cache():
+  check_frames(
+    "<p>some <b>bold</b> text</p><input>"
+    "<div style=background-color:lightblue>box</div>"
+    "<section><p>one</p><p>two</p></section><p>tail</p>", [
+    lambda s: s.tab.root_frame.focus_element(s.element("input")),
+    lambda s: s.tab.keypress("a"),
+    lambda s: s.tab.keypress("b"),
+    lambda s: s.js("document.querySelectorAll('div')[0]"
+      ".style = 'background-color:orange'"),
+    lambda s: s.js("document.querySelectorAll('section')[0]"
+      ".innerHTML = '<p>three</p>'"),
+    lambda s: s.js("document.querySelectorAll('b')[0]"
+      ".innerHTML = 'changed'"),
+  ])
+
+def test_layer_reuse():
+  check_frames(
+    "<div style=opacity:0.5;background-color:red>faded <b>text</b></div>"
+    "<p style=transform:translate(20px,10px);background-color:lightgreen>"
+    "moved</p><p>plain</p><section><i>animated</i></section>", [
+    lambda s: s.js("document.querySelectorAll('section')[0]"
+      ".style = 'opacity:0.9;transition:opacity 2s'"),
+    lambda s: s.js("document.querySelectorAll('b')[0]"
+      ".innerHTML = 'more text'"),
+    lambda s: s.js("document.querySelectorAll('div')[0]"
+      ".style = 'opacity:0.1;background-color:red'"),
+    lambda s: s.js("document.querySelectorAll('p')[0].style = "
+      "'transform:translate(60px,30px);background-color:lightgreen'"),
+    lambda s: s.js("document.querySelectorAll('p')[1]"
+      ".style = 'opacity:0.5'"),
+    lambda s: s.js("document.querySelectorAll('section')[0]"
+      ".style = 'opacity:0.2;transition:opacity 2s'"),
+    lambda s: None,
+    lambda s: s.js("document.querySelectorAll('b')[0]"
+      ".innerHTML = 'text'"),
+  ])
+
+def test_tiling():
+  html = "".join(
+    "<p>paragraph {} with <b>some</b> words</p>".format(i) for i in range(40)
+  ) + "<div style=opacity:0.8;background-color:lightblue>" + "".join(
+    "<p>faded {}</p>".format(i) for i in range(40)) + "</div><p>end</p>"
+  steps = [lambda s: s.browser.handle_down() for i in range(6)] + [
+    lambda s: s.js("document.querySelectorAll('b')[30]"
+      ".innerHTML = 'other'"),
+    lambda s: s.js("document.querySelectorAll('div')[0]"
+      ".style = 'opacity:0.4;background-color:lightblue'"),
+  ] + [lambda s: s.browser.handle_down() for i in range(2)] + [
+    lambda s: s.tab.scrolldown(),
+    lambda s: s.tab.scrolldown(),
+  ]
+  tile_size = draw.TILE_SIZE
+  for size in [tile_size, 96]:
+    draw.TILE_SIZE = size
+    try:
+      check_frames(html, steps)
+    finally:
+      draw.TILE_SIZE = tile_size
+
+def test_partial_redraw():
+  html = "<p>top</p><input><section><i>fading</i></section>" + "".join(
+    "<p>line {} of <b>text</b></p>".format(i) for i in range(40)
+  ) + "<div style=opacity:0.5;background-color:orange>layer</div>"
+  check_frames(html, [
+    lambda s: s.tab.root_frame.focus_element(s.element("input")),
+    lambda s: s.tab.keypress("x"),
+    lambda s: s.js("document.querySelectorAll('section')[0]"
+      ".style = 'opacity:0.3;transition:opacity 2s'"),
+    lambda s: None,
+    lambda s: s.browser.focus_addressbar(),
+    lambda s: s.browser.handle_key("a"),
+    lambda s: s.browser.handle_down(),
+    lambda s: s.browser.handle_down(),
+    lambda s: s.js("document.querySelectorAll('b')[5]"
+      ".innerHTML = 'changed'"),
+    lambda s: s.browser.handle_up(),
+    lambda s: s.js("document.querySelectorAll('div')[0]"
+      ".innerHTML = ''"),
+    lambda s: s.js("document.querySelectorAll('section')[0]"
+      ".innerHTML = ''"),
+  ])
+
+def evict_and_draw(s):
+  draw.TILE_CACHE.tiles.clear()
+  draw.TILE_CACHE.size = 0
+  s.browser.damage_all()
+  s.browser.set_needs_draw()
+  s.browser.composite_raster_and_draw()
+  assert s.browser.needs_raster or not s.incremental
+
+def test_missing_tiles():
+  html = "".join("<p>paragraph {}</p>".format(i) for i in range(60))
+  check_frames(html, [
+    evict_and_draw,
+    lambda s: s.browser.handle_down(),
+    evict_and_draw,
+  ])
+
+def test_focus_scroll():
+  html = "".join("<p>paragraph {}</p>".format(i) for i in range(400)) + "<input>"
+  s = Session(html, True)
+  s.frame()
+  s.tab.advance_tab()
+  pixels = s.frame()
+  assert s.browser.active_tab_scroll > 0
+  s.incremental = False
+  assert s.frame() == pixels